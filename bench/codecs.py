@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# compares the archive codecs that ArchiveTask can use on a synthetic release
+# tree that looks something like a python project with a bundled virtualenv.
+#
+#    bench/codecs.py [--files 20000] [--binary-mb 200] [--threads 0]
+#
+import argparse
+import tempfile
+import shutil
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from pushlib import compression  # noqa
+
+
+WORDS = ["import", "def", "return", "self", "class", "for", "in", "if", "else", "None", "True", "value", "path", "env", "run"]
+
+
+def make_tree(root, files, binary_mb):
+    rng = random.Random(1234)
+
+    # lots of small source files like a virtualenv has
+    for i in range(files):
+        path = os.path.join(root, "venv", "lib", "site-packages", "pkg{}".format(i % 200), "module{}.py".format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            for _ in range(rng.randint(20, 200)):
+                f.write(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))))
+                f.write("\n")
+
+    # a few large binaries that compress badly like shared libraries do
+    os.makedirs(os.path.join(root, "lib"), exist_ok=True)
+    for i in range(max(1, binary_mb // 10)):
+        with open(os.path.join(root, "lib", "ext{}.so".format(i)), "wb") as f:
+            # half random, half zeros, roughly how compiled code behaves
+            f.write(os.urandom(5 * 1024 * 1024))
+            f.write(bytes(5 * 1024 * 1024))
+
+
+def measure(command):
+    start = time.time()
+    times = os.times()
+    if (os.system(command) != 0):
+        raise RuntimeError("command failed: {}".format(command))
+    after = os.times()
+    return time.time() - start, (after.children_user - times.children_user) + (after.children_system - times.children_system)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare archive codecs")
+    parser.add_argument("--files", type=int, default=20000, help="number of small files to generate")
+    parser.add_argument("--binary-mb", type=int, default=200, help="megabytes of binary files to generate")
+    parser.add_argument("--threads", type=int, default=0, help="threads for multithreaded codecs (0 is all cores)")
+    parser.add_argument("--codec", action="append", help="only run these codecs")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="push-bench-")
+    try:
+        release = os.path.join(work, "release")
+        print("generating {} files and {}MB of binaries in {}".format(args.files, args.binary_mb, release))
+        make_tree(release, args.files, args.binary_mb)
+        total = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(release) for f in fs)
+
+        print("")
+        print("{:<8} {:>10} {:>8} {:>10} {:>10} {:>10}".format("codec", "size MB", "ratio", "create s", "cpu s", "extract s"))
+        for name in sorted(args.codec or compression.CODECS):
+            codec = compression.get(name)
+            if (codec.program is not None):
+                program = codec.program(None, 1).split()[0]
+                if (shutil.which(program) is None):
+                    print("{:<8} skipped, {} is not installed".format(name, program))
+                    continue
+
+            archive = os.path.join(work, "release.{}".format(codec.extension))
+            elapsed, cpu = measure(codec.create_command(release, archive, threads=args.threads))
+            size = os.path.getsize(archive)
+
+            extract = os.path.join(work, "extract")
+            os.makedirs(extract)
+            extracted, _ = measure("{} < {}".format(codec.extract_command(extract), archive))
+            shutil.rmtree(extract)
+            os.unlink(archive)
+
+            print("{:<8} {:>10.1f} {:>8.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(name, size / 1048576, total / size, elapsed, cpu, extracted))
+    finally:
+        shutil.rmtree(work)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# measures how long each stage of push takes on generated projects, deploying
+# to pretend hosts through a stand-in for ssh that unpacks into a temporary
+# directory. give it more than one push checkout to compare them.
+#
+#    bench/stages.py [--kind copy] [--files 2000] [--runs 3] [checkout ...]
+#
+# each run of each checkout happens in its own process that loads the project
+# through pushlib.loader and then calls the tasks one at a time, in order,
+# without their prerequisites so that each stage is timed on its own.
+import subprocess
+import statistics
+import argparse
+import tempfile
+import random
+import shutil
+import types
+import json
+import time
+import sys
+import os
+
+
+HERE = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+STAGES = ["clean", "build", "test", "archive", "clone", "live"]
+
+# every remote path starts with this. the stand-in for ssh puts it under a
+# directory for each host.
+REMOTE = "/bench-remote"
+
+# where live and clone deploy to, under the directory for each host
+DIRECTORIES = ["srv", "clone/bench{}/srv".format(REMOTE)]
+
+FAKE_SSH = """#!{python}
+# pretends to be ssh by running the command here, as this user, with every
+# path that starts with {remote} moved to a directory for the host.
+import subprocess
+import shlex
+import sys
+import re
+import os
+
+arguments = sys.argv[1:]
+i = 0
+while (i < len(arguments) and arguments[i].startswith("-")):
+    if (arguments[i] in ["-O", "-fN", "-N"]):
+        # connection sharing. there is no connection so it always works.
+        sys.exit(0)
+    i += 2 if arguments[i] in ["-o", "-p", "-l", "-i"] else 1
+
+# the directories that are deployed to already exist on a real host
+host = arguments[i]
+root = os.path.join({root!r}, host)
+for directory in {directories!r}:
+    os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+command = re.sub(r"(?<![\\w/.-]){remote}", root, " ".join(arguments[i + 1:]))
+parts = shlex.split(command)
+if (parts[:2] == ["sudo", "-u"]):
+    parts = parts[3:]
+sys.exit(subprocess.call(parts, cwd=root))
+"""
+
+
+def git(repo, *args):
+    subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost"] + list(args), cwd=repo, check=True, stdout=subprocess.DEVNULL)
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def make_repo(repo, kind, files, size, entries):
+    """generates a project and returns how many files and bytes are in it"""
+
+    os.makedirs(repo)
+    git(repo, "init", "-q")
+    git(repo, "remote", "add", "origin", "git@localhost:bench/bench.git")
+
+    pushrc = [
+        "from pushlib.modules.{} import *".format(kind),
+        "env.host_path = \"{}/srv\"".format(REMOTE),
+        "env.clone_host = \"bench-clone\"",
+        "env.clone_base_dir = \"{}/clone\"".format(REMOTE),
+        "env.clone_path = \"bench\"",
+        "env.no_tag = True",
+    ]
+    with open(os.path.join(repo, ".pushrc"), "w") as f:
+        f.write("\n".join(pushrc) + "\n")
+    with open(os.path.join(repo, ".gitignore"), "w") as f:
+        f.write(".push/\n")
+
+    # the same project every time so that runs can be compared
+    generator = random.Random(files)
+    total = 0
+
+    if (kind == "copy"):
+        for i in range(files):
+            data = generator.getrandbits(8 * size).to_bytes(size, "little") if i % 10 == 0 else ("line {}\n".format(i) * (size // 10)).encode()
+            write(os.path.join(repo, "lib", "d{}".format(i % 100), "f{}.dat".format(i)), data)
+            total += len(data)
+
+    if (kind == "python"):
+        write(os.path.join(repo, "setup.py"), b"from setuptools import setup, find_packages\nsetup(name='bench', version='1.0', packages=find_packages(exclude=['tests']), test_suite='tests')\n")
+        write(os.path.join(repo, "bench", "__init__.py"), b"")
+        for i in range(files):
+            data = "".join("def function_{}_{}(x):\n    return x + {}\n\n".format(i, j, j) for j in range(max(1, size // 40))).encode()
+            write(os.path.join(repo, "bench", "m{}".format(i // 100), "module{}.py".format(i)), data)
+            if (i % 100 == 0):
+                write(os.path.join(repo, "bench", "m{}".format(i // 100), "__init__.py"), b"")
+            total += len(data)
+        write(os.path.join(repo, "tests", "__init__.py"), b"")
+        write(os.path.join(repo, "tests", "test_bench.py"), b"import unittest\nclass Test(unittest.TestCase):\n    def test(self):\n        self.assertTrue(True)\n")
+
+    if (kind == "perl"):
+        write(os.path.join(repo, "Makefile.PL"), b"use ExtUtils::MakeMaker;\nWriteMakefile(NAME => 'Bench', VERSION => '1.0');\n")
+        for i in range(files):
+            data = "package Bench::M{0};\nsub f {{ return {0}; }}\n{1}1;\n".format(i, "# padding\n" * (size // 10)).encode()
+            write(os.path.join(repo, "lib", "Bench", "M{}.pm".format(i)), data)
+            total += len(data)
+        write(os.path.join(repo, "t", "basic.t"), b"use Test::More tests => 1;\nok(1);\n")
+
+    for i in range(entries):
+        data = "#!/bin/sh\necho {}\n".format(i).encode()
+        write(os.path.join(repo, "bin", "command{}".format(i)), data)
+        os.chmod(os.path.join(repo, "bin", "command{}".format(i)), 0o755)
+        total += len(data)
+
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "bench")
+    return files + entries, total
+
+
+def worker(args):
+    # pretend that this is the push program from the checkout being measured
+    sys.argv = [os.path.join(args.checkout, "push")]
+    sys.path.insert(0, args.checkout)
+    sys.dont_write_bytecode = True
+
+    # the pretend hosts that "live" deploys to
+    hosts = types.ModuleType("pushlib.hosts")
+    names = ["bench-{}".format(i) for i in range(args.hosts)]
+    hosts.hosts = {"tags": {"bench": names}, "servers": {name: [] for name in names}}
+    sys.modules["pushlib.hosts"] = hosts
+
+    from invoke import Context, Config
+    from pushlib import loader
+
+    c = Context(Config(overrides={"run": {"echo": False, "hide": True, "pty": False, "in_stream": False}}))
+    tasks = {
+        "clean": lambda: loader.clean_task(c),
+        "build": lambda: loader.build_task(c),
+        "test": lambda: loader.test_task(c),
+        "archive": lambda: loader.archive_task(c),
+        "clone": lambda: loader.clone_task(c),
+        "live": lambda: loader.live_task(c, "bench"),
+    }
+
+    results = {}
+    for stage in args.stages.split(","):
+        start = time.time()
+        try:
+            tasks[stage]()
+            ok = True
+        except BaseException as e:
+            ok = False
+            print("{} failed: {}".format(stage, e), file=sys.stderr)
+        results[stage] = {"seconds": time.time() - start, "ok": ok}
+
+        # nothing after a failed stage would mean anything
+        if (not ok):
+            break
+
+    with open(args.output, "w") as f:
+        json.dump(results, f)
+
+
+def measure(checkout, repo, stages, hosts, work, verbose):
+    output = os.path.join(work, "result.json")
+    command = [sys.executable, os.path.realpath(__file__), "--worker", "--checkout", checkout, "--output", output, "--stages", ",".join(stages), "--hosts", str(hosts)]
+
+    # the stand-in for ssh is found first and connections aren't shared. the
+    # caches are kept in here so that the bench never uses or changes the
+    # ones that push really uses, like the list of hosts.
+    cache = os.path.join(work, "cache")
+    environment = dict(os.environ, PATH="{}:{}".format(os.path.join(work, "bin"), os.environ.get("PATH", "")), SSH_MULTIPLEX="0", PUSH_CACHE_DIR=cache, XDG_CACHE_HOME=cache)
+    quiet = None if verbose else subprocess.DEVNULL
+    subprocess.run(command, cwd=repo, env=environment, stdin=subprocess.DEVNULL, stdout=quiet, stderr=quiet)
+
+    try:
+        with open(output) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+    finally:
+        if (os.path.exists(output)):
+            os.unlink(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure how long each stage of push takes")
+    parser.add_argument("--kind", choices=["copy", "python", "perl"], default="copy", help="what sort of project to generate")
+    parser.add_argument("--files", type=int, default=2000, help="number of source files in the project")
+    parser.add_argument("--size", type=int, default=4096, help="size of each source file in bytes")
+    parser.add_argument("--bin", type=int, default=20, help="number of files in bin/")
+    parser.add_argument("--hosts", type=int, default=3, help="number of hosts that live deploys to")
+    parser.add_argument("--runs", type=int, default=3, help="number of times to run every stage")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to run, in order")
+    parser.add_argument("--verbose", action="store_true", help="show what push prints")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--checkout", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    parser.add_argument("checkouts", nargs="*", help="push checkouts to compare (default: this one)")
+    args = parser.parse_args()
+
+    if (args.worker):
+        return worker(args)
+
+    checkouts = [os.path.realpath(x) for x in args.checkouts] or [HERE]
+    stages = args.stages.split(",")
+
+    work = tempfile.mkdtemp(prefix="push-bench-")
+    try:
+        remote = os.path.join(work, "remote")
+        write(os.path.join(work, "bin", "ssh"), FAKE_SSH.format(python=sys.executable, remote=REMOTE, root=remote, directories=DIRECTORIES).encode())
+        os.chmod(os.path.join(work, "bin", "ssh"), 0o755)
+
+        repo = os.path.join(work, "repo")
+        print("generating a {} project with {} files of {} bytes and {} in bin/".format(args.kind, args.files, args.size, args.bin))
+        count, size = make_repo(repo, args.kind, args.files, args.size, args.bin)
+
+        for checkout in checkouts:
+            if (args.kind != "copy" and not os.path.exists(os.path.join(checkout, "pushlib", "modules", "{}.py".format(args.kind)))):
+                print("")
+                print("{}: skipped because contrib/{}.py isn't installed in pushlib/modules".format(checkout, args.kind))
+                continue
+
+            times = {stage: [] for stage in stages}
+            failed = set()
+            for _ in range(args.runs):
+                shutil.rmtree(remote, ignore_errors=True)
+                shutil.rmtree(os.path.join(work, "cache"), ignore_errors=True)
+                results = measure(checkout, repo, stages, args.hosts, work, args.verbose)
+                for stage in stages:
+                    if (stage not in results or not results[stage]["ok"]):
+                        failed.add(stage)
+                    else:
+                        times[stage].append(results[stage]["seconds"])
+
+            print("")
+            print(checkout)
+            print("  {:<10} {:>10} {:>10} {:>12} {:>12}".format("stage", "median", "best", "files/s", "MB/s"))
+            for stage in stages:
+                if (stage in failed or len(times[stage]) == 0):
+                    print("  {:<10} {:>10}".format(stage, "FAILED"))
+                    continue
+                median = statistics.median(times[stage])
+                print("  {:<10} {:>9.3f}s {:>9.3f}s {:>12.0f} {:>12.1f}".format(stage, median, min(times[stage]), count / median, size / median / 1024 / 1024))
+    finally:
+        shutil.rmtree(work)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# measures how long push takes to start up in a large git repository. give it
+# more than one push to compare them, like an old checkout and a new one.
+#
+#    bench/startup.py [--files 50000] [--runs 5] [push ...]
+#
+import subprocess
+import statistics
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+
+HERE = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def git(repo, *args):
+    subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost"] + list(args), cwd=repo, check=True, stdout=subprocess.DEVNULL)
+
+
+def make_repo(repo, files, commits):
+    os.makedirs(repo)
+    git(repo, "init", "-q")
+    git(repo, "remote", "add", "origin", "git@localhost:bench/bench.git")
+
+    with open(os.path.join(repo, ".gitignore"), "w") as f:
+        f.write("*.log\n")
+    with open(os.path.join(repo, ".pushrc"), "w") as f:
+        f.write("from pushlib.modules.copy import *\n")
+
+    # every file in every commit is a loose object, which is what made the old
+    # startup slow.
+    per_commit = max(1, files // commits)
+    for commit in range(commits):
+        for i in range(per_commit):
+            path = os.path.join(repo, "lib", "d{}".format(i % 100), "f{}.txt".format(i))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("commit {} file {}\n".format(commit, i))
+        git(repo, "add", "-A")
+        git(repo, "commit", "-q", "-m", "commit {}".format(commit))
+    git(repo, "tag", "v1")
+
+
+def measure(push, repo, arguments, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.run([push] + arguments, cwd=repo, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure push startup time")
+    parser.add_argument("--files", type=int, default=50000, help="number of files in the repository")
+    parser.add_argument("--commits", type=int, default=5, help="number of commits to spread the files across")
+    parser.add_argument("--runs", type=int, default=5, help="number of times to run each command")
+    parser.add_argument("--repo", help="use this repository instead of generating one")
+    parser.add_argument("push", nargs="*", help="push executables to compare (default: this checkout)")
+    args = parser.parse_args()
+
+    pushes = [os.path.realpath(x) for x in args.push] or [os.path.join(HERE, "push")]
+
+    work = tempfile.mkdtemp(prefix="push-bench-")
+    try:
+        repo = args.repo
+        if (repo is None):
+            repo = os.path.join(work, "repo")
+            print("generating a repository with {} files in {} commits".format(args.files, args.commits))
+            make_repo(repo, args.files, args.commits)
+
+        commands = [["--help"], ["-l"], ["clean"]]
+
+        print("")
+        print("{:<40} {}".format("push", " ".join("{:>10}".format(" ".join(x)) for x in commands)))
+        for push in pushes:
+            results = [measure(push, repo, command, args.runs) for command in commands]
+            print("{:<40} {}".format(push[-40:], " ".join("{:>9.3f}s".format(x) for x in results)))
+    finally:
+        shutil.rmtree(work)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -1,43 +1,106 @@
 from invoke import run
+from ..tools import abort
 from .. import colors
+from .. import cache
 from .. import env
+import concurrent.futures
+import tempfile
+import shlex
 import os
 
 
 class JSHintTask(object):
     def __init__(self):
-        jshint = "{}/shared/jshint/jshint --verbose --extract=auto --config={}/shared/jshint/jshint.conf".format(env.push_dir, env.push_dir)
+        config = "{}/shared/jshint/jshint.conf".format(env.push_dir)
+        self.jshint = "{}/shared/jshint/jshint --verbose --extract=auto --config={}".format(env.push_dir, config)
 
-        # want to ignore files that haven't changed since the last time that
-        # jshint ran. though, this is useless when a "clean" has happened.
-        jshinted = "{}/.jshinted".format(env.test_dir)
-        if (not os.path.exists(jshinted)):
-            run("touch -m -t 200001010000 {}".format(jshinted))
+        # files that passed are remembered by their contents and the
+        # configuration that they passed with. this is kept outside of the
+        # project so that a "clean" doesn't throw it away.
+        self.cache = cache.Cache("jshint", cache.size_setting("jshint_cache_size", "16M"))
+        with open(config, "rb") as f:
+            self.config = cache.key(self.jshint, f.read())
 
-        # build a list of files to check
-        files = set()
+        # work out which files haven't passed before
+        files = {}
+        for path in self.files():
+            with open(path, "rb") as f:
+                key = cache.key(f.read(), self.config)
+            if (self.cache.get(key) is None):
+                files[path] = key
 
-        # add non-minified, non-third-party JavaScript
-        js_files = run("find {} -newer {} -type f -name \"*.js\" -not -name \"*.min.js\" -not -path \"*/third-party/*\" -not -path \"*/.eggs/*\"".format(env.build_dir, jshinted), hide=True).stdout.strip()
-        if (js_files):
-            for file in js_files.split("\n"):
-                files.add(file)
+        if (len(files) == 0):
+            print("Not running jshint because nothing has changed.")
+            return
 
-        # add html files plus any other extensions
+        failures = self.lint(files)
+        if (len(failures)):
+            for path, output in sorted(failures.items()):
+                print(colors.red(output))
+            abort("jshint found problems in {} of {} files.".format(len(failures), len(files)))
+
+        print(colors.green("Finished running jshint on {} files.".format(len(files))))
+
+    def files(self):
+        # non-minified, non-third-party JavaScript
         # NOTE: jshint doesn't work very well with Kolon (Perl) and Jinja
-        # (Python) templates so we are temporarily disabling thins.
-        # for extension in ["*.html"]:
-        #     other_files = run("find {} -newer {} -type f -name \"{}\" -not -path \"*/third-party/*\" -not -path \"*/.eggs/*\"".format(env.build_dir, jshinted, extension), hide=True).stdout.strip()
-        #     if (other_files):
-        #         for file in other_files.split("\n"):
-        #             files.add(file)
-
-        # now process the unique set of files
-        for f in files:
-            dot_nojshint = "{}/.nojshint".format(os.path.dirname(f))
-            if (os.path.exists(dot_nojshint)):
-                print(colors.yellow("Found .nojshint -- ignoring {}.".format(f)))
-            else:
-                run("{} {}".format(jshint, f))
-
-        run("touch {}".format(jshinted))
+        # (Python) templates so we aren't checking html files.
+        for directory, directories, names in os.walk(env.build_dir):
+            directories[:] = sorted(x for x in directories if x not in ["third-party", ".eggs"])
+
+            paths = [os.path.join(directory, x) for x in sorted(names) if x.endswith(".js") and not x.endswith(".min.js")]
+            if (len(paths) and os.path.exists(os.path.join(directory, ".nojshint"))):
+                for path in paths:
+                    print(colors.yellow("Found .nojshint -- ignoring {}.".format(path)))
+                continue
+
+            for path in paths:
+                yield path
+
+    def lint(self, files):
+        """runs jshint on batches of files at the same time. returns the output
+        for every file that failed."""
+
+        workers = int(env.get("jshint_jobs", os.environ.get("JSHINT_JOBS", 0))) or os.cpu_count() or 1
+        paths = sorted(files)
+        size = max(1, min(50, -(-len(paths) // workers)))
+        batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+
+        failures = {}
+        passed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch, result in zip(batches, executor.map(self._run, batches)):
+                # jshint starts every line about a problem with the name of
+                # the file that has the problem
+                output = {}
+                for line in result.stdout.splitlines():
+                    for path in batch:
+                        if (line.startswith("{}:".format(path))):
+                            output.setdefault(path, []).append(line)
+                            break
+
+                if (not result.ok and len(output) == 0):
+                    # failed without saying which file so blame all of them
+                    output = {path: [(result.stdout + result.stderr).strip()] for path in batch}
+
+                for path in batch:
+                    if (path in output):
+                        failures[path] = "\n".join(output[path])
+                    else:
+                        passed.append(path)
+
+        self._remember(passed, files)
+        return failures
+
+    def _run(self, batch):
+        return run("{} {}".format(self.jshint, " ".join(shlex.quote(x) for x in batch)), hide=True, warn=True, in_stream=False)
+
+    def _remember(self, paths, files):
+        # an entry only has the name of the file that passed in it. the
+        # ones that were used longest ago go once they are all put in.
+        with tempfile.TemporaryDirectory(prefix="push-jshint-") as directory:
+            for path in paths:
+                with open(os.path.join(directory, "path"), "w") as f:
+                    f.write(os.path.relpath(path, env.build_dir))
+                self.cache.put(files[path], directory, evict=False)
+        self.cache.evict()
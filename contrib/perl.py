@@ -1,7 +1,16 @@
 from invoke import run
 from ..tasks import *
+from ..tools import abort
+from .. import colors
+from .. import cache
+from .. import prune
+from .. import scheduler
+from .. import objcache
 from .. import tools
 from .. import env
+import shutil
+import shlex
+import sys
 import os
 
 
@@ -14,6 +23,8 @@ __all__ = [
     "ArchiveTask",
     "CloneTask",
     "LiveTask",
+    "RollbackTask",
+    "WatchTask",
     "DeployTask",
 ]
 
@@ -25,6 +36,10 @@ def load_defaults(c):
     env.perl_prove = c.run("which prove", hide=True).stdout.strip()
     env.perl_prove_dir = "{}/prove_db".format(env.test_dir)
 
+    # how long each test took last time. this is kept outside of the build
+    # directory so that it survives between builds.
+    env.perl_prove_state = "{}/prove.state".format(env.containment_dir)
+
     # these are settings that define where built stuff gets put
     env.perl_release_dir = env.release_dir
     env.perl_release_lib_dir = "{}/lib/perl".format(env.perl_release_dir)
@@ -39,16 +54,28 @@ class BuildTask(BuildTask):
         # figure out where perl and things are
         load_defaults(c)
 
-        # build the project using perl's build system.
+        # build the project using perl's build system. we are NOT copying
+        # bin or lib because perl handles those for us but we do still care
+        # about these other ones. when scheduling they happen at the same time.
+        paths = [path for path in ["etc", "web", "www"] if os.path.isdir(path)]
+        with scheduler.Graph() as steps:
+            steps.add(
+                "build.perl",
+                lambda: self.build_in(scheduler.context(c)),
+                inputs=[env.build_dir],
+                outputs=[env.perl_release_lib_dir, env.perl_release_bin_dir, env.perl_release_man_dir],
+            )
+            steps.add(
+                "build.copy",
+                lambda: tools.copy(paths),
+                inputs=[os.path.join(env.build_dir, path) for path in paths],
+                outputs=[os.path.join(env.release_dir, path) for path in paths],
+            )
+
+    def build_in(self, c):
         with c.cd(env.build_dir):
             self.build(c)
 
-        # we are NOT copying bin or lib because perl handles those for us.
-        # but we do still care about these other ones.
-        for path in ["etc", "web", "www"]:
-            if (os.path.isdir(path)):
-                tools.copy(path)
-
     def build(self, c):
         # this is define din here to allow it to change based on any changes to env
         layout = """PREFIX={release_directory} \
@@ -71,14 +98,44 @@ class BuildTask(BuildTask):
                         release_man_directory=env.perl_release_man_dir,
                     )  # noqa
 
-        if (os.path.isfile("{}/Makefile.PL".format(env.build_dir))):
-            c.run("{} Makefile.PL {}".format(env.perl, layout))
-            c.run("make install")
+        if (not self.inputs_changed()):
+            print(colors.yellow("Not running make because nothing has changed."))
+        elif (os.path.isfile("{}/Makefile.PL".format(env.build_dir))):
+            # an incremental build keeps the Makefile and everything that make
+            # built last time so make only rebuilds what has changed.
+            objects = self.object_cache()
+            # the Makefile lists every file that it installs so it is made
+            # again when files are added or removed
+            if (self.inputs_changed("Makefile.PL") or self.inputs_added_or_removed() or not os.path.isfile("{}/Makefile".format(env.build_dir))):
+                if (objects is not None):
+                    # compile through something that remembers what it built
+                    cc = c.run("{} -MConfig -e 'print $Config{{cc}}'".format(env.perl), hide=True).stdout.strip()
+                    layout = "{} CC={}".format(layout, shlex.quote("{} {}/pushlib/objcache.py {}".format(sys.executable, env.push_dir, cc)))
+                c.run("{} Makefile.PL {}".format(env.perl, layout))
+
+            # zero means one job for each core
+            jobs = int(env.get("perl_make_jobs", os.environ.get("PERL_MAKE_JOBS", 1))) or os.cpu_count() or 1
+            environment = {} if objects is None else {"PUSH_OBJECT_CACHE_DIR": objects}
+            c.run("make -j {}".format(jobs), env=environment)
+            c.run("make install", env=environment)
+
+            if (objects is not None):
+                objcache.evict(objects, cache.size_setting("perl_object_cache_size", "1G"))
 
             # get rid of cruft that isn't useful to us
-            c.run("find {} -type f -name .packlist -delete".format(env.perl_release_lib_dir))
-            c.run("find {} -type f -name perllocal.pod -delete".format(env.perl_release_lib_dir))
-            c.run("find {} -type d -empty -delete".format(env.perl_release_lib_dir))
+            report = prune.prune(env.perl_release_lib_dir, [
+                prune.Rule(".packlist", kind="file"),
+                prune.Rule("perllocal.pod", kind="file"),
+            ])
+            print("Pruned {}: {}.".format(env.perl_release_lib_dir, report))
+
+    def object_cache(self):
+        """returns where compiled objects are kept between builds or None if
+        they aren't"""
+
+        if (str(env.get("perl_object_cache", os.environ.get("PERL_OBJECT_CACHE", True))) in ["False", "0"]):
+            return None
+        return os.path.join(cache.cache_dir(), "perl-objects")
 
 
 class TestTask(TestTask):
@@ -93,5 +150,22 @@ class TestTask(TestTask):
             self.test(c)
 
     def test(self, c):
+        # tests can run at the same time, slowest first, using how long each
+        # one took the last time that they ran. zero means one for each core.
+        jobs = int(env.get("perl_test_jobs", os.environ.get("PERL_TEST_JOBS", 1))) or os.cpu_count() or 1
+        options = "-j {} --state=slow,save".format(jobs) if jobs > 1 else "--state=save"
+
+        # prove keeps its state in the directory that it runs from
+        state = "{}/.prove".format(env.build_dir)
+        if (os.path.isfile(env.perl_prove_state)):
+            shutil.copyfile(env.perl_prove_state, state)
+
         with c.prefix("FORMATTER_OUTPUT_DIR={}".format(env.perl_prove_dir)):
-            c.run("{} -l -r --timer t 1> {}/perltests.xml".format(env.perl_prove, env.test_dir))
+            result = c.run("{} -l -r --timer {} t 1> {}/perltests.xml".format(env.perl_prove, options, env.test_dir), warn=True)
+
+        # keep the timings even if something failed
+        if (os.path.isfile(state)):
+            shutil.copyfile(state, env.perl_prove_state)
+
+        if (not result.ok):
+            abort("Perl tests failed.")
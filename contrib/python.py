@@ -1,5 +1,11 @@
 from invoke import run
 from ..tasks import *
+from ..tools import abort
+from .. import colors
+from .. import cache
+from .. import prune
+from .. import manifest
+from .. import scheduler
 from .. import tools
 from .. import env
 import os
@@ -14,10 +20,16 @@ __all__ = [
     "ArchiveTask",
     "CloneTask",
     "LiveTask",
+    "RollbackTask",
+    "WatchTask",
     "DeployTask",
 ]
 
 
+# the file in each virtualenv that has the key of what it was made from
+VIRTUALENV_KEY = ".push-virtualenv"
+
+
 # load some defaults. these are set here so that they may be overridden by
 # other parts of the system if necessary.
 def load_defaults(c):
@@ -39,45 +51,105 @@ class BuildTask(BuildTask):
         # figure out where python and things are
         load_defaults(c)
 
-        # build the project using python's build system.
+        # build the project using python's build system. we are NOT copying
+        # bin or lib because python handles those for us but we do still care
+        # about these other ones. when scheduling they happen at the same time.
+        paths = [path for path in ["etc", "web", "www"] if os.path.isdir(path)]
+        with scheduler.Graph() as steps:
+            steps.add(
+                "build.python",
+                lambda: self.build_in(scheduler.context(c)),
+                inputs=[env.build_dir],
+                outputs=[
+                    os.path.join(env.python_release_dir, env.python_release_lib_dir),
+                    os.path.join(env.python_release_dir, env.python_release_bin_dir),
+                    env.python_virtualenv_root_dir,
+                ],
+            )
+            steps.add(
+                "build.copy",
+                lambda: tools.copy(paths),
+                inputs=[os.path.join(env.build_dir, path) for path in paths],
+                outputs=[os.path.join(env.release_dir, path) for path in paths],
+            )
+
+    def build_in(self, c):
         with c.cd(env.build_dir):
             self.build(c)
 
-        # we are NOT copying bin or lib because python handles those for us.
-        # but we do still care about these other ones.
-        for path in ["etc", "web", "www"]:
-            if (os.path.isdir(path)):
-                tools.copy(path)
-
     def build(self, c):
         # if we're running a virtualenv then we need to reload the defaults
         virtualenv_name = env.get("virtualenv", None)
 
         if (virtualenv_name is not None):
-            # make a place for the virtualenv to exist
-            os.makedirs(env.python_virtualenv_root_dir, exist_ok=True)
-
-            # remember where the default python installation went
-            system_python_virtualenv = env.python_virtualenv
-
-            # create the virtualenv
-            with c.cd(env.python_virtualenv_root_dir):
-                c.run("{} {}".format(system_python_virtualenv, virtualenv_name))
+            # an incremental build can keep the virtualenv from last time if
+            # the requirements haven't changed.
+            virtualenv_exists = os.path.isfile("{}/{}/bin/activate".format(env.python_virtualenv_root_dir, virtualenv_name))
+            virtualenv_changed = (not virtualenv_exists or self.inputs_changed("requirements.txt"))
+
+            # a virtualenv that was already built with the same python and the
+            # same requirements can be copied from the cache.
+            virtualenv_dir = "{}/{}".format(env.python_virtualenv_root_dir, virtualenv_name)
+            virtualenv_cache = self.virtualenv_cache()
+            virtualenv_key = None
+            if (virtualenv_changed):
+                virtualenv_key = self.virtualenv_key(c, virtualenv_dir)
+                if (virtualenv_cache is not None and virtualenv_cache.restore(virtualenv_key, virtualenv_dir, link=env.get("copy_link", os.environ.get("COPY_LINK", "reflink")))):
+                    print(colors.cyan("Restored virtualenv {} from cache.".format(virtualenv_name)))
+                    virtualenv_changed = False
+
+            if (virtualenv_changed):
+                # make a place for the virtualenv to exist
+                os.makedirs(env.python_virtualenv_root_dir, exist_ok=True)
+
+                # remember where the default python installation went
+                system_python_virtualenv = env.python_virtualenv
+
+                # create the virtualenv
+                with c.cd(env.python_virtualenv_root_dir):
+                    c.run("{} {}".format(system_python_virtualenv, virtualenv_name))
 
             with c.prefix("source {}/{}/bin/activate".format(env.python_virtualenv_root_dir, virtualenv_name)):
                 # re-load the default paths to make it uses the virtualenv python
                 load_defaults(c)
 
                 # load requirements into virtualenv
-                if (os.path.isfile("{}/requirements.txt".format(env.build_dir))):
+                if (virtualenv_changed and os.path.isfile("{}/requirements.txt".format(env.build_dir))):
                     c.run("{} install -r {}/requirements.txt".format(env.python_pip, env.build_dir))
 
+                # the virtualenv says what it was made from so that a deploy
+                # can tell if the host has one made from something else
+                if (virtualenv_changed):
+                    with open(os.path.join(virtualenv_dir, VIRTUALENV_KEY), "w") as f:
+                        f.write("{}\n".format(virtualenv_key))
+
+                # keep it for next time, before the project gets installed
+                if (virtualenv_changed and virtualenv_cache is not None):
+                    virtualenv_cache.put(virtualenv_key, virtualenv_dir)
+
                 # really build
                 self._build(c)
         else:
             # really build
             self._build(c)
 
+    def virtualenv_cache(self):
+        if (str(env.get("python_virtualenv_cache", os.environ.get("PYTHON_VIRTUALENV_CACHE", True))) not in ["True", "1"]):
+            return None
+        return cache.Cache("virtualenv", cache.size_setting("python_virtualenv_cache_size", "5G"))
+
+    def virtualenv_key(self, c, virtualenv_dir):
+        # the virtualenv depends on the python that made it and on what was
+        # installed into it. it also has its own path written all through it.
+        version = c.run("{} -c 'import sys; print(sys.version)'".format(env.python), hide=True).stdout.strip()
+        requirements = "{}/requirements.txt".format(env.build_dir)
+        if (os.path.isfile(requirements)):
+            with open(requirements, "rb") as f:
+                requirements = f.read()
+        else:
+            requirements = b""
+        return cache.key(version, env.python_virtualenv, requirements, virtualenv_dir)
+
     def _build(self, c):
         # this is defined in here to allow it to change based on any changes to env
         layout = """--root={release_directory} \
@@ -90,7 +162,9 @@ class BuildTask(BuildTask):
                         release_bin_directory=env.python_release_bin_dir,
                     )  # noqa
 
-        if (os.path.isfile("{}/setup.py".format(env.build_dir))):
+        if (not self.inputs_changed()):
+            print(colors.yellow("Not running setup.py because nothing has changed."))
+        elif (os.path.isfile("{}/setup.py".format(env.build_dir))):
             # build the project using python's build system
             c.run("{} setup.py install {}".format(env.python, layout))
 
@@ -121,30 +195,90 @@ class TestTask(TestTask):
             self._test(c)
 
     def _test(self, c):
-        if (os.path.isfile("{}/setup.py".format(env.build_dir))):
-            # test the project using python's build system
-            c.run("{} setup.py test".format(env.python))
+        runner = env.get("python_test_runner", os.environ.get("PYTHON_TEST_RUNNER", "setup.py"))
+
+        # when scheduling, the archive is made from the release directory while
+        # the tests run so they must not write bytecode into it
+        environment = {"PYTHONDONTWRITEBYTECODE": "1"} if scheduler.enabled() else {}
+        if (runner == "parallel"):
+            # find the tests in the build directory and run them in several
+            # processes at once, importing the project from what was built
+            jobs = int(env.get("python_test_jobs", os.environ.get("PYTHON_TEST_JOBS", 0)))
+            c.run("{} {}/pushlib/testrunner.py --start-directory {} --path {} --jobs {} --durations {} --junit {}".format(
+                env.python,
+                env.push_dir,
+                env.build_dir,
+                os.path.join(env.python_release_dir, env.python_release_lib_dir),
+                jobs,
+                "{}/python-test-durations.json".format(env.containment_dir),
+                "{}/pythontests.xml".format(env.test_dir),
+            ), env=environment)
+        elif (runner == "setup.py"):
+            if (os.path.isfile("{}/setup.py".format(env.build_dir))):
+                # test the project using python's build system
+                c.run("{} setup.py test".format(env.python), env=environment)
+        else:
+            abort("Unknown python_test_runner '{}'. Use 'setup.py' or 'parallel'.".format(runner))
 
 
 class ArchiveTask(ArchiveTask):
-    def before(self, c):
-        super().before(c)
+    def prune_rules(self):
+        lib = os.path.relpath(os.path.join(env.python_release_dir, env.python_release_lib_dir), env.release_dir)
 
         # get rid of cruft that isn't useful to us
-        c.run("find {}/{} -name \"*.egg-info\" -exec rm -rf {{}} +".format(env.python_release_dir, env.python_release_lib_dir))
-        c.run("find {}/{} -name \".eggs\" -exec rm -rf {{}} +".format(env.python_release_dir, env.python_release_lib_dir))
-        c.run("find {}/{} -name \"*.pth\" -exec rm -rf {{}} +".format(env.python_release_dir, env.python_release_lib_dir))
-        c.run("find {} -path {}/venv -prune -o -type d -name \"__pycache__\" -print -exec rm -rf {{}} +".format(env.release_dir, env.release_dir))
-        c.run("find {} -path {}/venv -prune -o -type f -name \"*.pyc\" -print -exec rm -rf {{}} +".format(env.release_dir, env.release_dir))
+        return super().prune_rules() + [
+            prune.Rule("*.egg-info", under=lib),
+            prune.Rule(".eggs", under=lib),
+            prune.Rule("*.pth", under=lib),
+            prune.Rule("__pycache__", kind="dir", exclude=["venv"]),
+            prune.Rule("*.pyc", kind="file", exclude=["venv"]),
+        ]
+
+    def prune(self, c):
+        super().prune(c)
+
+        if (str(env.get("python_precompile", os.environ.get("PYTHON_PRECOMPILE", False))) in ["True", "1"]):
+            self.precompile(c)
+
+    def precompile(self, c):
+        # compile everything now so that the deployed program doesn't have to
+        # when it first starts. the files record the path that they will have
+        # on the remote host and are checked against nothing so the same
+        # source always gives the same files. files that are already there,
+        # like the ones pip leaves in the virtualenv, are compiled again so
+        # that they are made the same way.
+        lib = os.path.join(env.python_release_dir, env.python_release_lib_dir)
+        directories = [(lib, os.path.join(env.host_path, os.path.relpath(lib, env.release_dir)))]
+
+        python = env.python
+        virtualenv_name = env.get("virtualenv", None)
+        if (virtualenv_name is not None):
+            # the virtualenv's python is the one that will run on the host
+            python = "{}/{}/bin/python".format(env.python_virtualenv_root_dir, virtualenv_name)
+            directories.append(("{}/{}".format(env.python_virtualenv_root_dir, virtualenv_name), "{}/venv/{}".format(env.host_path, virtualenv_name)))
+        python = env.get("python_precompile_interpreter", python)
 
-        # remove empty directories
-        c.run("find {} -type d -empty -delete".format(env.release_dir))
+        for local, remote in directories:
+            if (os.path.isdir(local)):
+                c.run("{} -m compileall -q -f -j 0 --invalidation-mode unchecked-hash -d {} {}".format(python, remote, local))
 
 
 class DeployTask(DeployTask):
     def before(self):
         super().before()
 
-        if (env.get("virtualenv") is not None):
+        if (env.get("virtualenv") is not None and not self.virtualenv_sent()):
             # remove the existing venv directory to clean out any old files
             self.clean("venv/{}".format(env.virtualenv))
+
+    def virtualenv_sent(self):
+        # when only sending what changed, a host that was last sent a
+        # virtualenv made from the same things only needs what is different
+        # in it. sending what changed removes what is gone.
+        if (not self.delta()):
+            return False
+
+        sent = manifest.load(self.manifest_path())
+        path = "venv/{}/{}".format(env.virtualenv, VIRTUALENV_KEY)
+        local = os.path.join(env.release_dir, path)
+        return (sent is not None and path in sent and os.path.isfile(local) and sent[path]["sha256"] == manifest.digest(local))
@@ -1,6 +1,7 @@
-from invoke import run
 from .. import colors
 from .. import env
+import time
+import stat
 import os
 
 
@@ -8,14 +9,64 @@ class WrapperTask(object):
     def __init__(self):
         # do bin/sbin wrapper links
         if (str(env.get("skip_wrappers", os.environ.get("SKIP_WRAPPERS", False))) not in ["True", "1"]):
-            for wrap in ["bin", "sbin"]:
-                if (os.path.isdir("{}/{}".format(env.release_dir, wrap))):
-                    os.makedirs(os.path.join(env.release_dir, wrap, ".{}".format(wrap)), exist_ok=True)
-                    files = [os.path.join(env.release_dir, wrap, f) for f in os.listdir(os.path.join(env.release_dir, wrap)) if not os.path.isdir(os.path.join(env.release_dir, wrap, f))]
-                    for f in files:
-                        path = os.path.dirname(f)
-                        base = os.path.basename(f)
-                        run("mv {} {}/.{}".format(f, path, wrap))
-                        run("ln -sf .wrapper {}".format(f))
+            start = time.time()
+            moves, skipped = self.plan()
+            self.apply(moves)
+            print("Created {} wrappers, {} already wrapped, in {:.2f}s.".format(len([x for x in moves if x[1] is not None]), skipped, time.time() - start))
         else:
             print(colors.yellow("Not creating wrappers because 'skip_wrappers' is set."))
+
+    def plan(self):
+        # work out everything that needs to move before touching anything.
+        # returns a list of (file, where it moves to or None if it is already
+        # there) and how many files were already wrapped by an earlier build.
+        moves = []
+        skipped = 0
+        for wrap in ["bin", "sbin"]:
+            directory = os.path.join(env.release_dir, wrap)
+            if (not os.path.isdir(directory)):
+                continue
+
+            with os.scandir(directory) as entries:
+                for entry in sorted(entries, key=lambda x: x.name):
+                    if (entry.is_dir()):
+                        continue
+                    if (entry.is_symlink() and os.readlink(entry.path) == ".wrapper"):
+                        skipped += 1
+                        continue
+
+                    # an incremental build copies the file over the link
+                    # again. if it is the same as the one that was moved last
+                    # time then only the link needs to be put back.
+                    target = os.path.join(directory, ".{}".format(wrap), entry.name)
+                    if (self.same(entry.path, target)):
+                        skipped += 1
+                        moves.append((entry.path, None))
+                    else:
+                        moves.append((entry.path, target))
+        return moves, skipped
+
+    def same(self, path, target):
+        # the same test that the copier uses to decide not to copy a file
+        try:
+            a, b = os.lstat(path), os.lstat(target)
+        except FileNotFoundError:
+            return False
+        return stat.S_ISREG(a.st_mode) and stat.S_ISREG(b.st_mode) and a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+    def apply(self, moves):
+        for path, target in moves:
+            # the file gets its new name while it still has the old one
+            if (target is not None):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if (os.path.lexists(target)):
+                    os.unlink(target)
+                os.link(path, target, follow_symlinks=False)
+
+            # then the link replaces the old name with a rename so that the
+            # name is never missing or half made
+            temporary = os.path.join(os.path.dirname(path), ".{}.wrapper.push".format(os.path.basename(path)))
+            if (os.path.lexists(temporary)):
+                os.unlink(temporary)
+            os.symlink(".wrapper", temporary)
+            os.replace(temporary, path)
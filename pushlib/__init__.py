@@ -1,9 +1,38 @@
+import threading
+
+
 # this is used by invoke
 __version__ = '5.0'
 
 
+# a value in the global data that isn't worked out until something asks for
+# it. this lets things that are expensive to find out be skipped entirely by
+# the tasks that don't need them.
+class Lazy(object):
+    def __init__(self, function):
+        self.function = function
+        self.lock = threading.Lock()
+
+
 # used to make an easy accessor to global data
 class AttributeDict(dict):
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if (isinstance(value, Lazy)):
+            with value.lock:
+                # someone else might have worked it out while we waited
+                value = super().__getitem__(key)
+                if (isinstance(value, Lazy)):
+                    value = value.function()
+                    self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
     def __getattr__(self, key):
         try:
             return self[key]
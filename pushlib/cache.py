@@ -0,0 +1,142 @@
+from . import sync
+from . import env
+import hashlib
+import shutil
+import os
+
+
+def cache_dir():
+    """where things that are kept between builds of any project go"""
+
+    default = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "push")
+    return env.get("cache_dir", os.environ.get("PUSH_CACHE_DIR", default))
+
+
+def key(*parts):
+    """turns anything into something that can be used as a cache key"""
+
+    h = hashlib.sha256()
+    for part in parts:
+        if (isinstance(part, str)):
+            part = part.encode("utf-8")
+        h.update(hashlib.sha256(part).digest())
+    return h.hexdigest()
+
+
+def size(path):
+    total = 0
+    for directory, directories, files in os.walk(path):
+        for name in files + directories:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+# a directory of directories, one for each key. when the whole thing gets
+# bigger than max_size bytes then the ones that were used longest ago are
+# thrown away first.
+class Cache(object):
+    def __init__(self, name, max_size=None):
+        self.root = os.path.join(cache_dir(), name)
+        self.max_size = max_size
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """returns the path to the directory that was stored with the given
+        key or None if there isn't one"""
+
+        entry = self._entry(key)
+        if (not os.path.isdir(os.path.join(entry, "data"))):
+            return None
+
+        # remember that this was just used
+        try:
+            os.utime(os.path.join(entry, "size"))
+        except FileNotFoundError:
+            return None
+        return os.path.join(entry, "data")
+
+    def restore(self, key, destination, link="reflink"):
+        """copy what was stored with the given key to the destination. returns
+        False if there is nothing stored with that key."""
+
+        path = self.get(key)
+        if (path is None):
+            return False
+
+        if (os.path.lexists(destination)):
+            shutil.rmtree(destination)
+        sync.Copier(link=link).copy(["{}/".format(path)], destination)
+        return True
+
+    def put(self, key, source, evict=True):
+        """store a copy of the source directory with the given key. when
+        storing a lot of things at once pass evict=False and call evict once
+        at the end."""
+
+        os.makedirs(self.root, exist_ok=True)
+
+        # build it off to the side and move it into place so that nothing
+        # ever finds half of an entry.
+        temporary = os.path.join(self.root, ".{}.{}".format(key, os.getpid()))
+        try:
+            sync.Copier(link="reflink").copy(["{}/".format(source)], os.path.join(temporary, "data"))
+            with open(os.path.join(temporary, "size"), "w") as f:
+                f.write(str(size(os.path.join(temporary, "data"))))
+            os.rename(temporary, self._entry(key))
+        except OSError:
+            # most likely someone else stored the same thing at the same time
+            shutil.rmtree(temporary, ignore_errors=True)
+
+        if (evict):
+            self.evict()
+
+    def entries(self):
+        """returns a list of (last used, size, key) for everything stored"""
+
+        result = []
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return result
+
+        for name in names:
+            path = os.path.join(self._entry(name), "size")
+            try:
+                with open(path) as f:
+                    result.append((os.stat(path).st_mtime, int(f.read().strip() or 0), name))
+            except (OSError, ValueError):
+                continue
+        return result
+
+    def evict(self):
+        if (self.max_size is None):
+            return
+
+        entries = sorted(self.entries())
+        total = sum(x[1] for x in entries)
+        while (total > self.max_size and len(entries)):
+            _, entry_size, name = entries.pop(0)
+            shutil.rmtree(self._entry(name), ignore_errors=True)
+            total -= entry_size
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def size_setting(name, default):
+    """reads a size in bytes from a setting, allowing things like "500M" """
+
+    return parse_size(env.get(name, os.environ.get(name.upper(), default)))
+
+
+def parse_size(value):
+    value = str(value)
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if (value[-1:].upper() in multipliers):
+        return int(float(value[:-1]) * multipliers[value[-1:].upper()])
+    return int(value)
@@ -0,0 +1,122 @@
+from . import env
+import hashlib
+import os
+
+
+# each codec knows how to get tar to compress an archive with it and how to
+# get tar on the remote host to decompress it again.
+class Codec(object):
+    def __init__(self, name, extension, program, extract):
+        self.name = name
+        self.extension = extension
+
+        # a function that is given the level and thread count and returns the
+        # command that tar should compress with or None for no compression.
+        self.program = program
+
+        # the option to give to tar on the remote host to decompress
+        self.extract = extract
+
+    def create_command(self, source, archive, level=None, threads=None, files=None, mtime=None):
+        if (level is None):
+            level = setting("archive_level")
+        if (threads is None):
+            threads = setting("archive_threads", 0)
+
+        # zero threads means use every core that we have
+        threads = int(threads) or os.cpu_count() or 1
+
+        # either everything in the source directory or just the paths that
+        # are listed in a file, separated by NUL characters.
+        members = "." if files is None else "--no-recursion --null -T {}".format(files)
+
+        # the same files always make the same archive. entries are in name
+        # order and don't say who made them. given a time, every file gets it.
+        options = "--sort=name --format=gnu --owner=0 --group=0 --numeric-owner"
+        if (mtime is not None):
+            options = "{} --mtime=@{}".format(options, int(mtime))
+
+        program = self.program(level, threads) if self.program else None
+        if (program is None):
+            return "tar {} -cf {} -C {} -p {}".format(options, archive, source, members)
+        return "tar {} --use-compress-program=\"{}\" -cf {} -C {} -p {}".format(options, program, archive, source, members)
+
+    def extract_command(self, path):
+        return "tar -x{} -f - -C {} -p --no-same-owner --overwrite-dir".format(self.extract, path)
+
+
+def _level(level, default):
+    return "-{}".format(level if level not in [None, ""] else default)
+
+
+CODECS = {
+    # plain old single threaded gzip, what we have always used. the header
+    # doesn't get a name or a time so that it is the same every time.
+    "gzip": Codec("gzip", "tar.gz", lambda level, threads: "gzip -n {}".format(_level(level, 6)), " -z"),
+
+    # gzip compressed on every core. remote hosts decompress it with gzip.
+    "pigz": Codec("pigz", "tar.gz", lambda level, threads: "pigz -n {} -p {}".format(_level(level, 6), threads), " -z"),
+
+    # much faster than gzip at the same ratio and multithreaded
+    "zstd": Codec("zstd", "tar.zst", lambda level, threads: "zstd -q {} -T{}".format(_level(level, 3), threads), " --zstd"),
+
+    # for fast local networks where compressing costs more than sending
+    "none": Codec("none", "tar", None, ""),
+}
+
+
+def setting(name, default=None):
+    return env.get(name, os.environ.get(name.upper(), default))
+
+
+def get(name=None):
+    """returns the codec with the given name or the configured one"""
+
+    if (name is None):
+        name = setting("archive_codec", "gzip")
+
+    if (name not in CODECS):
+        raise ValueError("unknown archive codec \"{}\", expected one of: {}".format(name, ", ".join(sorted(CODECS))))
+    return CODECS[name]
+
+
+def for_archive(path):
+    """returns the codec that can unpack the given archive"""
+
+    # the configured codec goes first so that pigz archives stay pigz
+    for codec in [get()] + list(CODECS.values()):
+        if (path.endswith(".{}".format(codec.extension))):
+            return codec
+    return get()
+
+
+def digest_path(archive):
+    return "{}.sha256".format(archive)
+
+
+def write_digest(archive):
+    """saves the sha256 of the archive next to it, like sha256sum does"""
+
+    sha = hashlib.sha256()
+    with open(archive, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+
+    temporary = "{}.{}.tmp".format(digest_path(archive), os.getpid())
+    with open(temporary, "w") as f:
+        f.write("{}  {}\n".format(sha.hexdigest(), os.path.basename(archive)))
+    os.replace(temporary, digest_path(archive))
+    return sha.hexdigest()
+
+
+def read_digest(archive):
+    """returns the saved sha256 of the archive, saving it if it wasn't"""
+
+    try:
+        with open(digest_path(archive)) as f:
+            value = f.read().split()[0]
+        if (os.path.getmtime(digest_path(archive)) >= os.path.getmtime(archive)):
+            return value
+    except (OSError, IndexError):
+        pass
+    return write_digest(archive)
@@ -0,0 +1,108 @@
+import re
+
+
+# one line from a .gitignore file
+class Pattern(object):
+    def __init__(self, line):
+        self.negate = False
+        self.directory = False
+
+        if (line.startswith("!")):
+            self.negate = True
+            line = line[1:]
+        elif (line.startswith("\\")):
+            # an escaped leading ! or #
+            line = line[1:]
+
+        if (line.endswith("/")):
+            self.directory = True
+            line = line.rstrip("/")
+
+        # a pattern with a slash in it is relative to the top of the copy.
+        # without one it can match a name in any directory.
+        anchored = ("/" in line)
+        line = line.lstrip("/")
+
+        self.regex = re.compile("{}{}$".format("" if anchored else "(?:.*/)?", translate(line)))
+
+    def match(self, path, is_dir):
+        if (self.directory and not is_dir):
+            return False
+        return self.regex.match(path) is not None
+
+
+def translate(pattern):
+    """turns a gitignore glob into a regular expression"""
+
+    result = []
+    i = 0
+    while (i < len(pattern)):
+        c = pattern[i]
+        if (pattern.startswith("**/", i)):
+            # any number of directories, including none
+            result.append("(?:.*/)?")
+            i += 3
+            continue
+        if (pattern.startswith("**", i)):
+            result.append(".*")
+            i += 2
+            continue
+
+        if (c == "*"):
+            result.append("[^/]*")
+        elif (c == "?"):
+            result.append("[^/]")
+        elif (c == "\\" and i + 1 < len(pattern)):
+            i += 1
+            result.append(re.escape(pattern[i]))
+        elif (c == "["):
+            end = pattern.find("]", i + 2)
+            if (end == -1):
+                result.append(re.escape(c))
+            else:
+                contents = pattern[i + 1:end]
+                if (contents.startswith("!")):
+                    contents = "^" + contents[1:]
+                result.append("[{}]".format(contents.replace("\\", "\\\\")))
+                i = end
+        else:
+            result.append(re.escape(c))
+        i += 1
+
+    return "".join(result)
+
+
+# a set of patterns from any number of .gitignore files. the last pattern that
+# matches a path decides whether it is ignored.
+class Rules(object):
+    def __init__(self, lines=None):
+        self.patterns = []
+        for line in (lines or []):
+            self.add(line)
+
+    def add(self, line):
+        line = line.rstrip("\n")
+
+        # trailing spaces are ignored unless they are escaped
+        if (not line.endswith("\\ ")):
+            line = line.rstrip()
+
+        if (line == "" or line.startswith("#")):
+            return
+        self.patterns.append(Pattern(line))
+
+    def load(self, path):
+        with open(path) as f:
+            for line in f:
+                self.add(line)
+        return self
+
+    def ignored(self, path, is_dir=False):
+        """path is relative to the top of whatever is being copied and uses
+        forward slashes"""
+
+        result = False
+        for pattern in self.patterns:
+            if (pattern.negate == result and pattern.match(path, is_dir)):
+                result = not pattern.negate
+        return result
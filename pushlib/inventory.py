@@ -0,0 +1,193 @@
+from .tools import warn, abort
+from . import cache
+from . import env
+import importlib
+import threading
+import fnmatch
+import atexit
+import json
+import time
+import re
+import os
+
+
+# the hosts that can be deployed to and the tags that group them, indexed so
+# that a selector can be resolved without looking at every host.
+class Inventory(object):
+    def __init__(self, hosts):
+        # tag name => set of host names
+        self.tags = {tag: frozenset(names) for tag, names in hosts.get("tags", {}).items()}
+
+        # host name => clone targets
+        self.servers = dict(hosts.get("servers", {}))
+
+        # everything that a glob or a regular expression can match
+        self.names = sorted(set(self.servers).union(*self.tags.values()))
+
+    def lookup(self, name):
+        """returns the hosts that a single name, glob or regular expression
+        stands for or None if it stands for nothing at all"""
+
+        if (len(name) > 2 and name.startswith("/") and name.endswith("/")):
+            pattern = re.compile(name[1:-1])
+            return set(x for x in self.names if pattern.search(x)) or None
+
+        if (any(x in name for x in "*?[")):
+            return set(fnmatch.filter(self.names, name)) or None
+
+        result = set(self.tags.get(name, ()))
+        if (name in self.servers):
+            result.add(name)
+        return result or None
+
+    def select(self, selector):
+        """resolve a selector like "web&prod,db*,!db3" to a set of hosts.
+        commas join groups together, ampersands only keep the hosts that are
+        in both and an exclamation mark takes hosts away. each name is a tag,
+        a host, a glob or a regular expression between slashes. returns the
+        hosts and a list of the names that didn't match anything."""
+
+        included = set()
+        excluded = set()
+        unknown = []
+
+        def resolve(name):
+            hosts = self.lookup(name)
+            if (hosts is None):
+                unknown.append(name)
+                return set()
+            return hosts
+
+        for group in [x.strip() for x in selector.split(",") if x.strip()]:
+            if (group.startswith("!") and "&" not in group):
+                excluded |= resolve(group[1:])
+                continue
+
+            result = None
+            for part in [x.strip() for x in group.split("&") if x.strip()]:
+                if (part.startswith("!")):
+                    result = (result if result is not None else set(self.names)) - resolve(part[1:])
+                else:
+                    hosts = resolve(part)
+                    result = hosts if result is None else result & hosts
+            included |= result or set()
+
+        return included - excluded, unknown
+
+
+def source():
+    """returns the function that fetches the hosts. env.inventory_source can
+    be that function or "module:name" where name is the hosts dict or a
+    function that returns it."""
+
+    value = env.get("inventory_source", os.environ.get("INVENTORY_SOURCE", "pushlib.hosts:hosts"))
+    if (callable(value)):
+        return value
+
+    module, _, name = value.partition(":")
+
+    def fetch():
+        result = getattr(importlib.import_module(module), name or "hosts")
+        return result() if callable(result) else result
+    return fetch
+
+
+def fetch():
+    hosts = source()()
+    if (not isinstance(hosts, dict) or not isinstance(hosts.get("servers", {}), dict) or not isinstance(hosts.get("tags", {}), dict)):
+        raise ValueError("the inventory source must give a dict with \"tags\" and \"servers\"")
+
+    # only keep what can be saved
+    return {
+        "tags": {str(tag): sorted(names) for tag, names in hosts.get("tags", {}).items()},
+        "servers": {str(name): list(targets or []) for name, targets in hosts.get("servers", {}).items()},
+    }
+
+
+def cache_path():
+    name = env.get("inventory_source", os.environ.get("INVENTORY_SOURCE", "pushlib.hosts:hosts"))
+    if (callable(name)):
+        name = "{}.{}".format(name.__module__, name.__qualname__)
+    return os.path.join(cache.cache_dir(), "inventory", "{}.json".format(cache.key(env.push_dir, str(name))[:16]))
+
+
+def load():
+    # returns when the hosts were fetched, when they were last tried to be
+    # fetched and the hosts
+    try:
+        with open(cache_path()) as f:
+            saved = json.load(f)
+        return saved["fetched"], saved.get("attempted", saved["fetched"]), saved["hosts"]
+    except (OSError, ValueError, KeyError):
+        return None, None, None
+
+
+def save(hosts, fetched=None):
+    # without the time they were fetched they were fetched just now
+    path = cache_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "w") as f:
+        json.dump({"fetched": fetched or time.time(), "attempted": time.time(), "hosts": hosts}, f)
+    os.replace(temporary, path)
+
+
+# a refresh that is running in the background
+refreshing = None
+
+
+def refresh():
+    try:
+        save(fetch())
+    except Exception as e:
+        warn("Could not refresh the host inventory, using what was saved before: {}".format(e))
+
+
+def finish():
+    # give a background refresh a moment to save what it found. a slow one is
+    # left behind and tried again once inventory_ttl has passed.
+    if (refreshing is not None):
+        refreshing.join(float(env.get("inventory_refresh_timeout", os.environ.get("INVENTORY_REFRESH_TIMEOUT", 2))))
+
+
+_inventory = None
+_lock = threading.Lock()
+
+
+def get():
+    """returns the inventory. what was fetched is saved and used for
+    inventory_ttl seconds. after that it is still used but fetched again in
+    the background for next time. it is only fetched while waiting when
+    nothing has been saved."""
+
+    global _inventory, refreshing
+    with _lock:
+        if (_inventory is not None):
+            return _inventory
+
+        ttl = float(env.get("inventory_ttl", os.environ.get("INVENTORY_TTL", 300)))
+        fetched, attempted, hosts = load()
+
+        if (hosts is None):
+            try:
+                hosts = fetch()
+            except Exception as e:
+                abort("Could not load the host inventory: {}".format(e))
+            try:
+                save(hosts)
+            except OSError as e:
+                warn("Could not save the host inventory: {}".format(e))
+        elif (time.time() - max(fetched, attempted) > ttl):
+            # write down that it was tried so that a source that is slow or
+            # down is only tried once every inventory_ttl seconds
+            try:
+                save(hosts, fetched)
+            except OSError as e:
+                warn("Could not save the host inventory: {}".format(e))
+
+            refreshing = threading.Thread(target=refresh, daemon=True)
+            refreshing.start()
+            atexit.register(finish)
+
+        _inventory = Inventory(hosts)
+        return _inventory
@@ -1,11 +1,14 @@
-from invoke import run
 from .tools import abort
+from . import compression
+from . import scheduler
+from . import profile
+from . import repo
 from . import env
+from . import Lazy
 import socket
 import pwd
 import sys
 import os
-import re
 
 
 # this is the name of the host that has clone on it
@@ -38,13 +41,11 @@ env.build_dir = "{}/build".format(env.containment_dir)
 env.archive_dir = "{}/archive".format(env.containment_dir)
 env.release_dir = "{}/release".format(env.containment_dir)
 env.test_dir = "{}/test".format(env.containment_dir)
+env.build_inputs = "{}/inputs.json".format(env.containment_dir)
 
 # the path to the root of the git repository. this also makes sure that we are
 # in a git repository.
-env.git_root_dir = run("git rev-parse --show-toplevel", hide=True, warn=True)
-if (not env.git_root_dir.ok):
-    abort("Could not find root of git repository. Is {} a git repository?".format(env.current_dir))
-env.git_root_dir = env.git_root_dir.stdout.strip()
+env.git_root_dir = repo.shared().get("git_root_dir") or repo.root_dir()
 
 # make sure we have some basic files
 if (not os.path.exists("{}/.gitignore".format(env.git_root_dir))):
@@ -52,38 +53,27 @@ if (not os.path.exists("{}/.gitignore".format(env.git_root_dir))):
 if (not os.path.exists("{}/.pushrc".format(os.getcwd()))):
     abort("Could not find .pushrc file in current directory.")
 
-# get the latest commit/tag and branch of the repo or HEAD if no commit/tag and/or branch
-git_objects_count = int(run("find {}/.git/objects -type f | wc -l | tr -d ' '".format(env.git_root_dir), hide=True, warn=True).stdout.strip())
-if (git_objects_count > 0):
-    # if we are in here then it means that at least one commit has been made
-    env.repo_commit_name = run("git log -1 | head -n 1", hide=True, warn=True).stdout.replace("commit", "").strip()
-    env.repo_branch_name = run("git rev-parse --abbrev-ref HEAD", hide=True, warn=True).stdout.strip()
-    env.repo_tag_names = run("git tag --contains {}".format(env.repo_commit_name), hide=True, warn=True).stdout.strip()
-
-if (env.get("repo_commit_name", "") == ""):
-    env.repo_commit_name = "HEAD"
-if (env.get("repo_branch_name", "") == ""):
-    env.repo_branch_name = "HEAD"
-if (env.get("repo_tag_names", "") == ""):
-    env.repo_tag_names = []
-else:
-    env.repo_tag_names = env.repo_tag_names.split("\n")
+# get the latest commit/tag and branch of the repo or HEAD if no commit/tag
+# and/or branch. asking git about these is slow on big repositories so it is
+# only done when a task actually uses one of them.
+env.repo_commit_name = Lazy(repo.commit_name)
+env.repo_branch_name = Lazy(repo.branch_name)
+env.repo_tag_names = Lazy(repo.tag_names)
+
+# when the latest commit was made. every file in the archive gets this time.
+env.repo_commit_time = Lazy(repo.commit_time)
 
 # is set to "true" if the repository is dirty
-git_dirty_state = run("git status -s", hide=True, warn=True).stdout.strip()
-env.repo_is_dirty = (git_dirty_state != "")
+env.repo_is_dirty = Lazy(repo.is_dirty)
 
 # this is the name of the project from which we are deploying
-env.git_origin = run("git ls-remote --get-url origin", hide=True, warn=True).stdout.strip()
-if (env.git_origin == "origin"):
-    abort("Could not find the origin for this git repository.")
+env.git_origin = Lazy(repo.origin)
 
 # the name of the project is based on the git project and the current directory
-project_name_match = re.search(r".*\/(.*)\.git$", env.git_origin)
-if (project_name_match):
-    env.project_name = project_name_match.group(1)
-else:
-    abort("Could not extract project name from origin.")
+env.project_name = Lazy(repo.project_name)
+
+# push-batch works all of that out once for every component that it pushes
+env.update(repo.shared())
 
 if (os.path.normpath(os.getcwd()) != os.path.normpath(env.git_root_dir)):
     # if we are in a subdirectory to our git project then use that subdirectory
@@ -94,11 +84,8 @@ else:
     # otherwise we have no distinct component
     env.project_component = ""
 
-# the name of the archive we will create when asked to create the archive.
-env.archive_name = "{}-{}-v{}.tar.gz".format(env.project_name, env.project_component, env.repo_commit_name)
-
-# where am i
-env.hostname = socket.getfqdn()
+# where am i. this can be slow if dns is slow.
+env.hostname = Lazy(socket.getfqdn)
 
 # who am i
 env.username = pwd.getpwuid(os.getuid())[0]
@@ -111,15 +98,42 @@ except Exception as e:
     # this is because printing to stderr in python2 is not the same as python3
     abort("Could not load .pushrc file: {}".format(e))
 
+
+# the name of the archive we will create when asked to create the archive. this
+# is done after loading the .pushrc file because the extension depends on the
+# compression that the project has chosen.
+def archive_name():
+    try:
+        extension = compression.get().extension
+    except ValueError as e:
+        abort("Could not determine archive name: {}".format(e))
+    return "{}-{}-v{}.{}".format(env.project_name, env.project_component, env.repo_commit_name, extension)
+
+
+if ("archive_name" not in env):
+    env.archive_name = Lazy(archive_name)
+
 # now create and assign the deploy class. this way if the user's .pushrc file
 # overrides it we can use the overridden version.
 env.deploy = DeployTask
 
+# time everything if asked to
+profile.install()
+
 # now create all of the tasks based on what was imported most recently
 clean_task = CleanTask()
 mostlyclean_task = MostlyCleanTask()
-build_task = BuildTask(pre=[mostlyclean_task])
+build_task = BuildTask(pre=[] if BuildTask.incremental() else [mostlyclean_task])
 test_task = TestTask(pre=[build_task])
-archive_task = ArchiveTask(pre=[test_task])
-clone_task = CloneTask(pre=[archive_task])
-live_task = LiveTask(pre=[archive_task])
+# when scheduling, the tests run while the archive is being made
+if (scheduler.enabled()):
+    archive_task = ArchiveTask(pre=[build_task], tests=test_task)
+else:
+    archive_task = ArchiveTask(pre=[test_task])
+
+# deploying can use the archive that is already there without building again
+deploy_pre = [] if str(env.get("no_build", os.environ.get("NO_BUILD", False))) in ["True", "1"] else [archive_task]
+clone_task = CloneTask(pre=deploy_pre)
+live_task = LiveTask(pre=deploy_pre)
+rollback_task = RollbackTask()
+watch_task = WatchTask(build=build_task, test=test_task, archive=archive_task)
@@ -0,0 +1,149 @@
+import threading
+import hashlib
+import stat
+import json
+import os
+
+
+# the most recent scan of each directory. hashes are reused from it for files
+# whose size and modification time have not changed.
+scans = {}
+scans_lock = threading.Lock()
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan(root, previous=None, paths=None):
+    """returns a dict keyed by the path of every file and symlink under root,
+    relative to root, with the size, mode, modification time and sha256 of
+    each one. symlinks get a mode of "link" and the hash of their target. if
+    paths is given then only those paths are looked at."""
+
+    if (previous is None):
+        with scans_lock:
+            previous = scans.get(root, {})
+
+    result = {}
+    if (paths is not None):
+        for path in paths:
+            try:
+                info = os.lstat(os.path.join(root, path))
+            except FileNotFoundError:
+                continue
+            _add(result, root, path, info, previous)
+    else:
+        directories = [""]
+        while (len(directories)):
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(os.path.join(root, directory)))
+            except FileNotFoundError:
+                continue
+
+            for entry in entries:
+                path = os.path.join(directory, entry.name)
+                if (entry.is_dir(follow_symlinks=False)):
+                    directories.append(path)
+                else:
+                    _add(result, root, path, entry.stat(follow_symlinks=False), previous)
+
+        with scans_lock:
+            scans[root] = result
+
+    return result
+
+
+def _add(result, root, path, info, previous):
+    if (stat.S_ISLNK(info.st_mode)):
+        target = os.readlink(os.path.join(root, path))
+        result[path] = {"size": len(target), "mode": "link", "mtime": info.st_mtime, "sha256": hashlib.sha256(target.encode()).hexdigest()}
+    elif (stat.S_ISREG(info.st_mode)):
+        mode = format(stat.S_IMODE(info.st_mode), "o")
+        old = previous.get(path)
+        if (old is not None and old["size"] == info.st_size and old["mtime"] == info.st_mtime):
+            sha256 = old["sha256"]
+        else:
+            sha256 = digest(os.path.join(root, path))
+        result[path] = {"size": info.st_size, "mode": mode, "mtime": info.st_mtime, "sha256": sha256}
+
+
+def same(a, b):
+    return (a is not None and b is not None and a["size"] == b["size"] and a["mode"] == b["mode"] and a["sha256"] == b["sha256"])
+
+
+def diff(local, remote):
+    """returns a list of paths that need to be sent and a list of paths that
+    need to be removed to make remote look like local"""
+
+    changed = sorted(path for path in local if not same(local[path], remote.get(path)))
+    removed = sorted(path for path in remote if path not in local)
+    return changed, removed
+
+
+def without(manifest, path):
+    """returns the manifest without anything at or underneath path"""
+
+    path = os.path.normpath(path)
+    prefix = "{}/".format(path)
+    return {k: v for k, v in manifest.items() if k != path and not k.startswith(prefix)}
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # write it somewhere else first so that a half written file never exists
+    temporary = "{}.{}".format(path, threading.get_ident())
+    with open(temporary, "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def parse_remote(output):
+    """turns the output of the remote manifest command into a manifest. the
+    output is "size mode path" lines then a blank line then sha256sum lines."""
+
+    sizes, _, sums = output.partition("\n\n")
+
+    result = {}
+    for line in sizes.split("\n"):
+        parts = line.split(" ", 2)
+        if (len(parts) == 3 and parts[0].isdigit()):
+            result[parts[2]] = {"size": int(parts[0]), "mode": parts[1], "mtime": 0, "sha256": None}
+
+    for line in sums.split("\n"):
+        # sha256sum escapes weird file names and puts a backslash in front of
+        # the line. we'll just send those again.
+        if (len(line) > 66 and not line.startswith("\\") and line[64:66] == "  "):
+            path = line[66:]
+            if (path in result):
+                result[path]["sha256"] = line[:64]
+
+    return result
+
+
+# the command run on the remote host to build a manifest of the files named on
+# its standard input, separated by NUL characters.
+REMOTE_COMMAND = " ".join([
+    "cd {} 2>/dev/null || exit 0;",
+    "list=$(mktemp) || exit 1;",
+    "cat > $list;",
+    "xargs -0 -r -a $list stat -c '%s %a %n' -- 2>/dev/null;",
+    "echo;",
+    "xargs -0 -r -a $list sha256sum -- 2>/dev/null;",
+    "rm -f $list;",
+    "exit 0",
+])
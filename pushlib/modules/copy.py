@@ -13,6 +13,8 @@ __all__ = [
     "ArchiveTask",
     "CloneTask",
     "LiveTask",
+    "RollbackTask",
+    "WatchTask",
     "DeployTask",
 ]
 
@@ -21,6 +23,5 @@ class BuildTask(BuildTask):
     def after(self, c):
         super().after(c)
 
-        for path in ["bin", "sbin", "lib", "etc", "web", "www"]:
-            if (os.path.isdir(path)):
-                tools.copy(path)
+        # copy everything in one go
+        tools.copy([path for path in ["bin", "sbin", "lib", "etc", "web", "www"] if os.path.isdir(path)])
@@ -0,0 +1 @@
+../../contrib/jshint.py
\ No newline at end of file
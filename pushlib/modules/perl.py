@@ -0,0 +1 @@
+../../contrib/perl.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../contrib/python.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../contrib/wrapper.py
\ No newline at end of file
@@ -0,0 +1,142 @@
+# a compiler wrapper that remembers the object files that it builds. use it in
+# place of a c compiler like this:
+#
+#     python3 objcache.py cc -c -O2 foo.c
+#
+# an object file is reused when the preprocessed source, the compiler and the
+# arguments given to the compiler are all the same as last time. anything that
+# isn't compiling one source file to one object file is passed straight through
+# to the compiler. the cache goes in $PUSH_OBJECT_CACHE_DIR. this runs once for
+# every file that is compiled so it only uses the standard library.
+import subprocess
+import hashlib
+import sys
+import os
+
+
+SOURCES = (".c", ".cc", ".cpp", ".cxx", ".C")
+
+
+def compiler_identity(compiler):
+    # the compiler binary itself changing means everything has to be rebuilt
+    path = compiler
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        if (os.sep not in compiler and os.path.isfile(os.path.join(directory, compiler))):
+            path = os.path.join(directory, compiler)
+            break
+    path = os.path.realpath(path)
+    info = os.stat(path)
+    return "{}:{}:{}".format(path, info.st_size, info.st_mtime_ns)
+
+
+def parse(arguments):
+    """returns the source file, the object file and the arguments without the
+    output or None if this isn't a simple compile"""
+
+    if ("-c" not in arguments):
+        return None
+
+    sources = [x for x in arguments if x.endswith(SOURCES) and not x.startswith("-")]
+    if (len(sources) != 1):
+        return None
+
+    # dependency files are a second output that we don't keep
+    if (any(x.startswith(("-M", "-save-temps")) for x in arguments)):
+        return None
+
+    output = None
+    rest = []
+    i = 0
+    while (i < len(arguments)):
+        if (arguments[i] == "-o" and i + 1 < len(arguments)):
+            output = arguments[i + 1]
+            i += 2
+            continue
+        if (arguments[i].startswith("-o") and len(arguments[i]) > 2):
+            output = arguments[i][2:]
+        else:
+            rest.append(arguments[i])
+        i += 1
+
+    if (output is None):
+        output = os.path.splitext(os.path.basename(sources[0]))[0] + ".o"
+    return sources[0], output, rest
+
+
+def key(compiler, arguments):
+    preprocess = [compiler] + [x for x in arguments if x != "-c"] + ["-E"]
+    result = subprocess.run(preprocess, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if (result.returncode != 0):
+        return None
+
+    h = hashlib.sha256()
+    for part in [compiler_identity(compiler), "\0".join(arguments)]:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(result.stdout)
+    return h.hexdigest()
+
+
+def main(command):
+    compiler, arguments = command[0], command[1:]
+    directory = os.environ.get("PUSH_OBJECT_CACHE_DIR")
+    parsed = parse(arguments) if directory else None
+    if (parsed is None):
+        return subprocess.call(command)
+
+    _, output, rest = parsed
+    try:
+        digest = key(compiler, rest)
+    except OSError:
+        digest = None
+    if (digest is None):
+        return subprocess.call(command)
+
+    cached = os.path.join(directory, digest[:2], "{}.o".format(digest))
+    if (os.path.isfile(cached)):
+        temporary = "{}.{}.push".format(output, os.getpid())
+        with open(cached, "rb") as s, open(temporary, "wb") as t:
+            t.write(s.read())
+        os.replace(temporary, output)
+
+        # remember that this was just used
+        os.utime(cached)
+        return 0
+
+    code = subprocess.call(command)
+    if (code == 0 and os.path.isfile(output)):
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        temporary = "{}.{}.push".format(cached, os.getpid())
+        with open(output, "rb") as s, open(temporary, "wb") as t:
+            t.write(s.read())
+        os.replace(temporary, cached)
+    return code
+
+
+def evict(directory, max_size):
+    """remove the objects that were used longest ago until everything in the
+    directory fits in max_size bytes"""
+
+    objects = []
+    for parent, directories, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(parent, name)
+            try:
+                info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            objects.append((info.st_mtime, info.st_size, path))
+
+    objects.sort()
+    total = sum(x[1] for x in objects)
+    while (total > max_size and len(objects)):
+        _, size, path = objects.pop(0)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
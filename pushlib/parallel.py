@@ -0,0 +1,161 @@
+from invoke.exceptions import UnexpectedExit
+from collections import namedtuple
+from . import colors
+from . import env
+import concurrent.futures
+import threading
+import time
+import sys
+import io
+import os
+
+
+# the outcome of running something against one host
+Result = namedtuple("Result", ["host", "ok", "duration", "error"])
+
+
+# writes lines to a stream with a prefix in front of each one
+class HostStream(object):
+    def __init__(self, stream, prefix, lock):
+        self.stream = stream
+        self.prefix = prefix
+        self.lock = lock
+        self.newline = True
+
+    def write(self, data):
+        with self.lock:
+            for line in data.splitlines(True):
+                if (self.newline):
+                    self.stream.write(self.prefix)
+                self.stream.write(line)
+                self.newline = line.endswith("\n")
+        return len(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, key):
+        return getattr(self.stream, key)
+
+
+# output from every thread goes through this so that each line that a thread
+# writes can be prefixed with the name of the host that it is working on.
+class PrefixedStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def set_prefix(self, prefix):
+        self.local.stream = HostStream(self.stream, prefix, self.lock)
+
+    def current(self):
+        return getattr(self.local, "stream", self.stream)
+
+    def write(self, data):
+        return self.current().write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, key):
+        return getattr(self.stream, key)
+
+
+def streams():
+    """returns keyword arguments for "run" so that the output of commands that
+    are run while deploying in parallel gets prefixed with the host name"""
+
+    # invoke writes command output from its own threads so it needs to be
+    # given the stream for this thread explicitly.
+    if (isinstance(sys.stdout, PrefixedStream)):
+        return {"out_stream": sys.stdout.current(), "err_stream": sys.stderr.current()}
+    return {}
+
+
+def worker_count(value=None):
+    # the command line wins, then the .pushrc file, then the environment
+    if (not value):
+        value = env.get("parallel", os.environ.get("PARALLEL", 1))
+
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+
+def run(hosts, function, workers):
+    """call function(host) for every host using at most "workers" threads and
+    return a list of results in the same order as the hosts"""
+
+    if (len(hosts) == 0):
+        return []
+
+    stdout = PrefixedStream(sys.stdout)
+    stderr = PrefixedStream(sys.stderr)
+    width = max(len(host) for host in hosts)
+
+    def target(host):
+        prefix = colors.blue("[{}] ".format(host.ljust(width)))
+        stdout.set_prefix(prefix)
+        stderr.set_prefix(prefix)
+
+        start = time.time()
+        try:
+            function(host)
+            return Result(host, True, time.time() - start, None)
+        except SystemExit as e:
+            # this is what "abort" raises
+            return Result(host, False, time.time() - start, getattr(e, "message", str(e)))
+        except UnexpectedExit as e:
+            # the last thing the command complained about is usually the most
+            # useful thing to put into the summary.
+            errors = e.result.stderr.strip().split("\n")
+            message = "exit code {}: {}".format(e.result.exited, errors[-1]).strip(": ")
+            return Result(host, False, time.time() - start, message)
+        except Exception as e:
+            return Result(host, False, time.time() - start, str(e) or e.__class__.__name__)
+
+    # commands that get run in parallel must not read from the terminal or
+    # they will steal answers from each other and from any prompts.
+    original = (sys.stdout, sys.stderr, sys.stdin)
+    sys.stdout, sys.stderr, sys.stdin = stdout, stderr, io.StringIO()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(target, hosts))
+    finally:
+        sys.stdout, sys.stderr, sys.stdin = original
+
+
+def merge(*phases):
+    """combine the results of several steps that were run against the same
+    hosts. a host that failed one step is not expected in the later steps."""
+
+    merged = []
+    for result in phases[0]:
+        duration = 0
+        for phase in phases:
+            for other in phase:
+                if (other.host == result.host):
+                    duration += other.duration
+                    if (not other.ok):
+                        result = other
+        merged.append(Result(result.host, result.ok, duration, result.error))
+    return merged
+
+
+def summary(results):
+    width = max(len(result.host) for result in results)
+
+    print("")
+    for result in results:
+        if (result.ok):
+            status = colors.green("ok")
+        else:
+            status = colors.red("FAILED: {}".format(result.error))
+        print("  {}  {:>8.1f}s  {}".format(result.host.ljust(width), result.duration, status))
+
+    failed = len([x for x in results if not x.ok])
+    print("")
+    print("{} succeeded, {} failed.".format(len(results) - failed, failed))
+    print("")
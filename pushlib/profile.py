@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from . import env
+import invoke.runners
+import contextlib
+import functools
+import threading
+import resource
+import atexit
+import json
+import time
+import sys
+import os
+
+
+# everything that has been timed so far
+spans = []
+
+# how many bytes were sent to each host
+transfers = OrderedDict()
+
+# the subprocess spans that are running right now
+running = {}
+
+lock = threading.Lock()
+origin = time.perf_counter()
+
+
+def enabled():
+    return str(env.get("profile", os.environ.get("PROFILE", False))) in ["True", "1"]
+
+
+@contextlib.contextmanager
+def span(name, category="task", **args):
+    """use as "with profile.span(name):" to time whatever is in the block"""
+
+    if (not enabled()):
+        yield
+        return
+
+    record = {"name": name, "category": category, "args": args, "thread": threading.get_ident(), "overlapped": False}
+    start = time.perf_counter()
+    cpu = time.thread_time()
+
+    # the cpu time of a subprocess can only be found by asking for the total
+    # of every subprocess so it isn't known if another one ran at the same time
+    children = None
+    if (category == "subprocess"):
+        with lock:
+            if (len(running)):
+                record["overlapped"] = True
+                for other in running.values():
+                    other["overlapped"] = True
+            running[id(record)] = record
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    try:
+        yield
+    finally:
+        record["start"] = start - origin
+        record["wall"] = time.perf_counter() - start
+        record["cpu"] = time.thread_time() - cpu
+
+        with lock:
+            if (children is not None):
+                del running[id(record)]
+                if (record["overlapped"]):
+                    record["cpu"] = None
+                else:
+                    now = resource.getrusage(resource.RUSAGE_CHILDREN)
+                    record["cpu"] = (now.ru_utime - children.ru_utime) + (now.ru_stime - children.ru_stime)
+            spans.append(record)
+
+
+def wrap(function, name, category="task", **args):
+    """returns the function changed so that every call to it is timed"""
+
+    if (not enabled()):
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*a, **kw):
+        with span(name, category, **args):
+            return function(*a, **kw)
+    return wrapper
+
+
+def sent(host, count):
+    with lock:
+        transfers[host] = transfers.get(host, 0) + count
+
+
+def install():
+    """start timing every command that invoke runs and print what was timed
+    when push finishes"""
+
+    if (not enabled() or getattr(invoke.runners.Runner.run, "profiled", False)):
+        return
+
+    original = invoke.runners.Runner.run
+
+    def run(self, command, **kwargs):
+        with span(" ".join(command.split())[:60], "subprocess", command=command):
+            return original(self, command, **kwargs)
+    run.profiled = True
+    invoke.runners.Runner.run = run
+
+    atexit.register(finish)
+
+
+def summary():
+    rows = OrderedDict()
+    for record in sorted(spans, key=lambda x: x["start"]):
+        if (record["category"] == "subprocess"):
+            continue
+        row = rows.setdefault(record["name"], [0, 0.0, 0.0])
+        row[0] += 1
+        row[1] += record["wall"]
+        row[2] += record["cpu"] or 0
+
+    commands = sorted([x for x in spans if x["category"] == "subprocess"], key=lambda x: -x["wall"])
+
+    print("")
+    print("{:<40}  {:>5}  {:>9}  {:>9}".format("phase", "calls", "wall", "cpu"))
+    for name, (count, wall, cpu) in rows.items():
+        print("{:<40}  {:>5}  {:>8.2f}s  {:>8.2f}s".format(name[:40], count, wall, cpu))
+
+    if (len(commands)):
+        print("")
+        print("{:<60}  {:>9}  {:>9}".format("slowest commands", "wall", "cpu"))
+        for record in commands[:10]:
+            cpu = "-" if record["cpu"] is None else "{:.2f}s".format(record["cpu"])
+            print("{:<60}  {:>8.2f}s  {:>9}".format(record["name"], record["wall"], cpu))
+        print("{} commands took {:.2f}s in total.".format(len(commands), sum(x["wall"] for x in commands)))
+
+    if (len(transfers)):
+        print("")
+        print("{:<40}  {:>12}".format("host", "bytes sent"))
+        for host, count in transfers.items():
+            print("{:<40}  {:>12}".format(host, count))
+    print("")
+
+
+def trace(path):
+    """writes everything that was timed in the format that chrome's tracing
+    tool and perfetto read"""
+
+    events = []
+    for record in spans:
+        args = dict(record["args"])
+        if (record["cpu"] is not None):
+            args["cpu"] = round(record["cpu"], 6)
+        events.append({
+            "name": record["name"],
+            "cat": record["category"],
+            "ph": "X",
+            "ts": int(record["start"] * 1000000),
+            "dur": int(record["wall"] * 1000000),
+            "pid": os.getpid(),
+            "tid": record["thread"],
+            "args": args,
+        })
+    for host, count in transfers.items():
+        events.append({"name": "bytes sent", "ph": "C", "ts": 0, "pid": os.getpid(), "args": {host: count}})
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def finish():
+    if (len(spans) == 0):
+        return
+
+    # this runs as push exits so don't let it change how push exits
+    try:
+        summary()
+        path = env.get("profile_trace", os.environ.get("PROFILE_TRACE"))
+        if (path):
+            trace(path)
+            print("Wrote trace to {}.".format(path))
+    except Exception as e:
+        print("Could not write profile: {}".format(e), file=sys.stderr)
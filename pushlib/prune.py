@@ -0,0 +1,89 @@
+from collections import OrderedDict
+import fnmatch
+import shutil
+import time
+import os
+
+
+# something to remove from a directory tree. name is matched against the name
+# of each file or directory. kind is "file", "dir" or None for either. under
+# limits the rule to things inside of that path, relative to the top of the
+# tree, and nothing inside of any of the exclude paths is touched.
+class Rule(object):
+    def __init__(self, name, kind=None, under=None, exclude=None):
+        self.name = name
+        self.kind = kind
+        self.under = os.path.normpath(under) if under else None
+        self.exclude = [os.path.normpath(x) for x in (exclude or [])]
+
+    def __str__(self):
+        return self.name if self.under is None else "{}/**/{}".format(self.under, self.name)
+
+    def match(self, path, name, is_dir):
+        if (self.kind == "file" and is_dir):
+            return False
+        if (self.kind == "dir" and not is_dir):
+            return False
+        if (not fnmatch.fnmatchcase(name, self.name)):
+            return False
+        if (self.under is not None and not path.startswith("{}/".format(self.under))):
+            return False
+        for exclude in self.exclude:
+            if (path == exclude or path.startswith("{}/".format(exclude))):
+                return False
+        return True
+
+
+# what a prune did
+class Report(object):
+    def __init__(self, rules):
+        self.removed = OrderedDict((str(rule), 0) for rule in rules)
+        self.empty = 0
+        self.seconds = 0
+
+    def __str__(self):
+        parts = ["{} {}".format(count, name) for name, count in self.removed.items() if count]
+        if (self.empty):
+            parts.append("{} empty directories".format(self.empty))
+        if (len(parts) == 0):
+            parts.append("nothing")
+        return "removed {} in {:.2f}s".format(", ".join(parts), self.seconds)
+
+
+def prune(root, rules, empty=True):
+    """walk the tree under root once, removing everything that matches any of
+    the rules and, if empty is True, every directory left empty. the root
+    itself is never removed. returns a report of what was removed."""
+
+    report = Report(rules)
+    start = time.time()
+
+    def walk(directory, relative):
+        remaining = 0
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+
+        for entry in entries:
+            path = "{}/{}".format(relative, entry.name) if relative else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+
+            rule = next((x for x in rules if x.match(path, entry.name, is_dir)), None)
+            if (rule is not None):
+                if (is_dir):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+                report.removed[str(rule)] += 1
+            elif (is_dir and walk(entry.path, path) and empty):
+                os.rmdir(entry.path)
+                report.empty += 1
+            else:
+                remaining += 1
+
+        return remaining == 0
+
+    if (os.path.isdir(root)):
+        walk(root, "")
+
+    report.seconds = time.time() - start
+    return report
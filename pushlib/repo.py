@@ -0,0 +1,123 @@
+from invoke import run
+from .tools import abort, listing
+from . import env
+import functools
+import shlex
+import json
+import re
+import os
+
+
+# everything in here asks git about the repository. each function is only
+# called the first time that something needs its answer.
+
+
+def root_dir():
+    # the path to the root of the git repository. this also makes sure that
+    # we are in a git repository.
+    result = run("git rev-parse --show-toplevel", hide=True, warn=True, in_stream=False)
+    if (not result.ok):
+        abort("Could not find root of git repository. Is {} a git repository?".format(env.current_dir))
+    return result.stdout.strip()
+
+
+@functools.lru_cache(maxsize=None)
+def head():
+    # get the latest commit and branch of the repo in one go. this fails when
+    # no commit has been made yet in which case both are just HEAD.
+    result = run("git rev-parse HEAD --abbrev-ref HEAD", hide=True, warn=True, in_stream=False)
+    lines = result.stdout.strip().split("\n") if result.ok else []
+    if (len(lines) != 2):
+        return "HEAD", "HEAD"
+    return (lines[0].strip() or "HEAD"), (lines[1].strip() or "HEAD")
+
+
+def commit_name():
+    return head()[0]
+
+
+def branch_name():
+    return head()[1]
+
+
+def commit_time():
+    # when the latest commit was made, as a unix timestamp, or None if no
+    # commit has been made yet
+    if (env.repo_commit_name == "HEAD"):
+        return None
+
+    result = run("git log -1 --format=%ct {}".format(env.repo_commit_name), hide=True, warn=True, in_stream=False)
+    return int(result.stdout.strip()) if result.ok and result.stdout.strip().isdigit() else None
+
+
+def tag_names():
+    # an empty repository has no tags
+    if (env.repo_commit_name == "HEAD"):
+        return []
+
+    tags = run("git tag --contains {}".format(env.repo_commit_name), hide=True, warn=True, in_stream=False).stdout.strip()
+    return tags.split("\n") if tags else []
+
+
+def is_dirty():
+    return run("git status --porcelain", hide=True, warn=True, in_stream=False).stdout.strip() != ""
+
+
+def origin():
+    # this is the name of the project from which we are deploying
+    origin = run("git ls-remote --get-url origin", hide=True, warn=True, in_stream=False).stdout.strip()
+    if (origin == "origin" or origin == ""):
+        abort("Could not find the origin for this git repository.")
+    return origin
+
+
+def project_name():
+    # the name of the project is based on the git project
+    match = re.search(r".*\/(.*)\.git$", env.git_origin)
+    if (not match):
+        abort("Could not extract project name from origin.")
+    return match.group(1)
+
+
+def inputs():
+    # every file in the current directory that git would consider part of the
+    # project, tracked or not, but not things that are ignored.
+    files = run("git ls-files -z --cached --others --exclude-standard", hide=True, warn=True, in_stream=False).stdout
+    return sorted(set(x for x in files.split("\0") if x and not x.startswith(".push/")))
+
+
+def ignored(paths):
+    # the ones that git would ignore. directories need a trailing slash to
+    # match patterns that only match directories.
+    with listing(paths) as names:
+        result = run("git check-ignore -z --stdin < {}".format(shlex.quote(names)), hide=True, warn=True, in_stream=False)
+    return set(x for x in result.stdout.split("\0") if x)
+
+
+# the values that several push processes working on the same repository can
+# work out once and share
+SHARED = ["git_root_dir", "repo_commit_name", "repo_branch_name", "repo_commit_time", "repo_tag_names", "repo_is_dirty", "git_origin", "project_name"]
+
+
+def metadata():
+    # everything above, worked out now, to be given to other push processes
+    # in the PUSH_REPO environment variable.
+    env.git_root_dir = root_dir()
+    env.repo_commit_name = commit_name()
+    env.repo_branch_name = branch_name()
+    env.repo_commit_time = commit_time()
+    env.repo_tag_names = tag_names()
+    env.repo_is_dirty = is_dirty()
+    env.git_origin = origin()
+    env.project_name = project_name()
+    return {key: env[key] for key in SHARED}
+
+
+@functools.lru_cache(maxsize=None)
+def shared():
+    # what another push process already worked out for us, if anything
+    try:
+        values = json.loads(os.environ.get("PUSH_REPO", "{}"))
+    except ValueError:
+        return {}
+    return {key: value for key, value in values.items() if key in SHARED}
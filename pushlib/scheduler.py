@@ -0,0 +1,151 @@
+from invoke import Context
+from . import profile
+from . import env
+import concurrent.futures
+import io
+import os
+
+
+# runs steps that say which paths they read and which paths they write. a
+# step waits for every step added before it that writes something that it
+# reads or writes or that reads something that it writes. everything else
+# runs at the same time. when scheduling is turned off every step runs one
+# after another in the order that they were added.
+
+
+def enabled():
+    return str(env.get("schedule", os.environ.get("SCHEDULE", False))) in ["True", "1"]
+
+
+def workers():
+    if (not enabled()):
+        return 1
+
+    # zero means one for each core
+    return int(env.get("schedule_jobs", os.environ.get("SCHEDULE_JOBS", 0))) or os.cpu_count() or 1
+
+
+def context(c):
+    """returns a copy of the invoke context for use in another thread. "cd"
+    and "prefix" change the context that they are used on so two steps can't
+    share one."""
+
+    # steps that run at the same time can't all read from the terminal or
+    # set it up for a pty. like the hosts when deploying in parallel they get
+    # an empty stdin instead.
+    config = c.config
+    if (workers() > 1):
+        config = config.clone()
+        config.run.in_stream = io.StringIO()
+        config.run.pty = False
+
+    copy = Context(config=config)
+    copy._set(command_prefixes=list(c.command_prefixes), command_cwds=list(c.command_cwds))
+    return copy
+
+
+def _overlaps(a, b):
+    for x in a:
+        for y in b:
+            if (x == y or x.startswith(y + os.sep) or y.startswith(x + os.sep)):
+                return True
+    return False
+
+
+class Step(object):
+    def __init__(self, name, function, inputs=(), outputs=(), after=(), discard=None):
+        self.name = name
+        self.function = function
+        self.inputs = [os.path.abspath(x) for x in inputs]
+        self.outputs = [os.path.abspath(x) for x in outputs]
+
+        # the names of steps that have to finish first no matter what they
+        # read and write
+        self.after = list(after)
+
+        # called if this step finished but another one failed so that what it
+        # made can be thrown away
+        self.discard = discard
+
+    def needs(self, other):
+        return (
+            other.name in self.after or
+            _overlaps(self.inputs, other.outputs) or
+            _overlaps(self.outputs, other.outputs) or
+            _overlaps(self.outputs, other.inputs)
+        )
+
+
+class Graph(object):
+    """use as "with scheduler.Graph() as steps:" and call steps.add in the
+    block. the steps run when the block ends."""
+
+    def __init__(self, jobs=None):
+        self.steps = []
+        self.jobs = jobs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if (kind is None):
+            self.run()
+
+    def add(self, name, function, inputs=(), outputs=(), after=(), discard=None):
+        self.steps.append(Step(name, function, inputs, outputs, after, discard))
+
+    def run(self):
+        jobs = self.jobs or workers()
+
+        # one at a time is just the order that they were added in
+        if (jobs == 1):
+            finished = []
+            try:
+                for step in self.steps:
+                    profile.wrap(step.function, "step.{}".format(step.name))()
+                    finished.append(step)
+            except BaseException:
+                self.discard(finished)
+                raise
+            return
+
+        # work out what each step waits for from the order they were added
+        waiting = {}
+        for i, step in enumerate(self.steps):
+            waiting[step.name] = set(x.name for x in self.steps[:i] if step.needs(x))
+
+        finished = []
+        failure = None
+        running = {}
+        pending = list(self.steps)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            while (len(pending) or len(running)):
+                # start whatever isn't waiting on anything, in order, unless
+                # something has failed
+                if (failure is None):
+                    for step in [x for x in pending if not waiting[x.name]][:jobs - len(running)]:
+                        pending.remove(step)
+                        running[executor.submit(profile.wrap(step.function, "step.{}".format(step.name)))] = step
+                if (len(running) == 0):
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    if (future.exception() is not None):
+                        if (failure is None):
+                            failure = future.exception()
+                        continue
+                    finished.append(step)
+                    for name in waiting:
+                        waiting[name].discard(step.name)
+
+        if (failure is not None):
+            self.discard(finished)
+            raise failure
+
+    def discard(self, finished):
+        for step in reversed(finished):
+            if (step.discard is not None):
+                step.discard()
@@ -0,0 +1,160 @@
+from invoke import run
+from .tools import abort
+from . import env
+import threading
+import tempfile
+import atexit
+import fcntl
+import shutil
+import re
+import os
+
+
+# what ssh says when it couldn't reach the host at all
+UNREACHABLE = re.compile(r"connect to host|Could not resolve hostname|Connection (timed out|refused|reset)")
+
+
+# one multiplexed connection to a host that every ssh command to that host
+# goes through. it is opened the first time it is needed and closed when push
+# exits.
+class Connection(object):
+    def __init__(self, host, directory):
+        self.host = host
+        self.path = os.path.join(directory, "%C")
+        self.opened = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def options(self, timeout):
+        with self.lock:
+            if (self.opened is None):
+                self.opened = self.open(timeout)
+
+        if (self.opened):
+            return "-o ControlMaster=no -o ControlPath={}".format(self.path)
+
+        # connecting without a master connection would only wait out the
+        # timeout again so say why the master couldn't connect instead.
+        if (self.error is not None):
+            abort("Could not connect to {}: {}".format(self.host, self.error))
+
+        # if we couldn't open a master connection for some other reason then
+        # just connect normally and let the real command report whatever is
+        # wrong.
+        return ""
+
+    def open(self, timeout):
+        # other push processes might share the directory so only one of them
+        # at a time gets to open a connection to a host and if one of them
+        # already has then we use it.
+        with open(os.path.join(os.path.dirname(self.path), "{}.lock".format(self.host)), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if (self.check()):
+                return True
+
+            # the master connection must not hold on to our output or invoke
+            # will wait on it forever. it goes away by itself once it has not
+            # been used for a while in case push is killed before it can
+            # close it.
+            persist = int(env.get("ssh_persist", os.environ.get("SSH_PERSIST", 60)))
+            with tempfile.NamedTemporaryFile(prefix="push-ssh-", mode="r") as errors:
+                result = run("ssh -o ConnectTimeout={} -o ControlMaster=yes -o ControlPersist={} -o ControlPath={} -fN {} </dev/null >/dev/null 2>{}".format(timeout, persist, self.path, self.host, errors.name), hide=True, warn=True, in_stream=False)
+                message = errors.read().strip()
+
+            # ssh exits with 255 for its own errors
+            if (not result.ok and result.exited == 255 and UNREACHABLE.search(message)):
+                self.error = message.split("\n")[-1]
+            return result.ok
+
+    def check(self):
+        # whether there is a master connection to the host
+        return run("ssh -o ControlPath={} -O check {}".format(self.path, self.host), hide=True, warn=True, in_stream=False).ok
+
+    def close(self):
+        if (self.opened):
+            run("ssh -o ControlPath={} -O exit {}".format(self.path, self.host), hide=True, warn=True, in_stream=False)
+        self.opened = None
+
+
+connections = {}
+connections_lock = threading.Lock()
+directory = None
+
+
+def enabled():
+    return str(env.get("ssh_multiplex", os.environ.get("SSH_MULTIPLEX", True))) in ["True", "1"]
+
+
+def options(host, timeout=10):
+    """returns the options to give to ssh to use the shared connection to the
+    given host, opening the connection if it hasn't been opened yet"""
+
+    global directory
+
+    if (not enabled()):
+        return ""
+
+    with connections_lock:
+        if (directory is None and os.environ.get("PUSH_SSH_DIR")):
+            # another push process, like push-batch, owns the connections and
+            # closes them when it is done with them.
+            directory = os.environ["PUSH_SSH_DIR"]
+        if (directory is None):
+            # the control sockets live in a short path because unix sockets
+            # have a small limit on the length of their names.
+            directory = start()
+
+        if (host not in connections):
+            connections[host] = Connection(host, directory)
+        connection = connections[host]
+
+    return connection.options(timeout)
+
+
+def refresh():
+    """forget the connections that have gone away since they were opened,
+    like ones that weren't used for ssh_persist seconds, so that the next
+    command to each of those hosts opens a new one"""
+
+    with connections_lock:
+        for host, connection in list(connections.items()):
+            if (connection.opened and not connection.check()):
+                del connections[host]
+
+
+def reset():
+    """forget every connection that this process opened so that the next
+    command to each host opens a new one, in case the old one went away"""
+
+    with connections_lock:
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
+
+
+def start():
+    """make a directory for connections that this process closes when it
+    exits. other push processes use it when it is in PUSH_SSH_DIR."""
+
+    global directory
+
+    directory = tempfile.mkdtemp(prefix="push-ssh-")
+    atexit.register(close_all)
+    return directory
+
+
+def close_all():
+    global directory
+
+    with connections_lock:
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
+
+        if (directory is not None and directory != os.environ.get("PUSH_SSH_DIR")):
+            # close the ones that other push processes opened too
+            for name in os.listdir(directory):
+                if (not name.endswith(".lock")):
+                    run("ssh -o ControlPath={} -O exit push".format(os.path.join(directory, name)), hide=True, warn=True, in_stream=False)
+            shutil.rmtree(directory, ignore_errors=True)
+        directory = None
@@ -0,0 +1,156 @@
+from .parallel import Result, HostStream
+from . import colors
+import subprocess
+import threading
+import signal
+import queue
+import time
+import sys
+import os
+
+
+# this is how much we read from the archive at a time
+CHUNK_SIZE = 256 * 1024
+
+
+# one remote host that is being sent the stream
+class Destination(object):
+    def __init__(self, host, command, lock, width, space):
+        self.host = host
+        self.error = None
+        self.last_line = ""
+        self.started = time.time()
+        self.finished = None
+
+        # every host gets its own queue of chunks. how many are in it is how
+        # far the host is behind the reader.
+        self.chunks = queue.Queue()
+
+        # told every time a chunk is taken off of the queue
+        self.space = space
+
+        self.output = HostStream(sys.stdout, colors.blue("[{}] ".format(host.ljust(width))), lock)
+        self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def _write(self):
+        # keep taking chunks until told to stop even if the host has failed so
+        # that whoever is giving us chunks never gets stuck.
+        chunk = self.taken()
+        while (chunk is not None):
+            if (self.ok):
+                try:
+                    self.process.stdin.write(chunk)
+                except (BrokenPipeError, ValueError, OSError):
+                    # the remote end went away. the exit code will say why.
+                    self.fail("connection closed while sending")
+            chunk = self.taken()
+
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+    def _read(self):
+        for line in iter(self.process.stdout.readline, b""):
+            line = line.decode("utf-8", "replace")
+            self.output.write(line)
+            if (line.strip()):
+                self.last_line = line.strip()
+
+    def taken(self):
+        chunk = self.chunks.get()
+        with self.space:
+            self.space.notify_all()
+        return chunk
+
+    def behind(self):
+        return self.chunks.qsize()
+
+    def send(self, chunk):
+        self.chunks.put(chunk)
+
+    def fail(self, error):
+        if (self.error is None):
+            self.error = error
+
+            # stop whatever the remote host is doing. this also unblocks the
+            # writer if it is stuck writing to the remote host.
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+            with self.space:
+                self.space.notify_all()
+
+    def wait(self):
+        self.chunks.put(None)
+        self.writer.join()
+        code = self.process.wait()
+        self.reader.join()
+        if (self.ok and code != 0):
+            self.error = "exit code {}: {}".format(code, self.last_line).strip(": ")
+        self.finished = time.time()
+
+    def result(self):
+        return Result(self.host, self.ok, self.finished - self.started, self.error)
+
+
+def send(path, commands, lag=16 * 1024 * 1024, timeout=30):
+    """read the file at path once and send it to the standard input of every
+    command in the commands dict, keyed by host. the file is read as fast as
+    the fastest host takes it. a host is dropped if it falls "lag" bytes
+    behind the fastest one or if none of them take anything for "timeout"
+    seconds. returns a list of results."""
+
+    if (len(commands) == 0):
+        return []
+
+    lock = threading.Lock()
+    space = threading.Condition()
+    buffer = max(1, lag // CHUNK_SIZE)
+    width = max(len(host) for host in commands)
+    destinations = [Destination(host, commands[host], lock, width, space) for host in sorted(commands)]
+
+    with open(path, "rb") as f:
+        while (True):
+            chunk = f.read(CHUNK_SIZE)
+            if (not chunk):
+                break
+
+            alive = [x for x in destinations if x.ok]
+            if (len(alive) == 0):
+                break
+
+            # only read ahead of the fastest host by so much. the reader never
+            # waits on any other host. a host that is that far behind the
+            # fastest one is dropped instead.
+            with space:
+                if (not space.wait_for(lambda: not any(x.ok for x in alive) or min(x.behind() for x in alive if x.ok) < buffer, timeout)):
+                    for destination in alive:
+                        destination.fail("no progress in {} seconds".format(timeout))
+                    break
+
+                alive = [x for x in alive if x.ok]
+                fastest = min([x.behind() for x in alive] or [0])
+                for destination in alive:
+                    if (destination.behind() - fastest >= buffer):
+                        destination.fail("fell {} bytes behind the fastest host".format(buffer * CHUNK_SIZE))
+
+            for destination in alive:
+                if (destination.ok):
+                    destination.send(chunk)
+
+    for destination in destinations:
+        destination.wait()
+
+    return [x.result() for x in destinations]
@@ -0,0 +1,161 @@
+import threading
+import fcntl
+import shutil
+import stat
+import os
+
+
+# the ioctl that asks the filesystem to share the blocks of one file with
+# another. this is linux specific and filesystems that can't do it say so.
+FICLONE = 0x40049409
+
+
+# what happened during a copy
+class Stats(object):
+    def __init__(self):
+        self.copied = []
+        self.skipped = 0
+        self.bytes = 0
+
+
+# copies files like "rsync -a --numeric-ids" does but without starting a new
+# process for every copy. files that are already the same size and have the
+# same modification time in the destination are skipped.
+class Copier(object):
+    def __init__(self, rules=None, link="reflink", skip=None):
+        # an ignore.Rules object for what should not be copied
+        self.rules = rules
+
+        # directories that are never copied. the destination is one of them
+        # so that copying a directory into itself doesn't go on forever.
+        self.skip = set(os.path.realpath(x) for x in (skip or []))
+
+        # "hardlink" links files instead of copying them, "reflink" asks the
+        # filesystem to share the blocks if it can and "copy" just copies.
+        self.link = link
+
+        self.owner = (os.geteuid() == 0)
+
+    def copy(self, sources, destination):
+        """copy each of the sources into the destination. like rsync, a source
+        that ends with a slash has its contents copied rather than itself."""
+
+        stats = Stats()
+        os.makedirs(destination, exist_ok=True)
+        self.skip.add(os.path.realpath(destination))
+
+        for source in sources:
+            if (source.endswith("/")):
+                source = source.rstrip("/") or "/"
+                info = os.stat(source)
+                self._directory(source, destination, "", info, stats, top=True)
+            else:
+                name = os.path.basename(source)
+                info = os.lstat(source)
+                if (not self._ignored(name, stat.S_ISDIR(info.st_mode))):
+                    self._entry(source, os.path.join(destination, name), name, info, stats)
+
+        return stats
+
+    def _ignored(self, relative, is_dir):
+        return self.rules is not None and self.rules.ignored(relative, is_dir)
+
+    def _entry(self, source, target, relative, info, stats):
+        if (stat.S_ISDIR(info.st_mode)):
+            self._directory(source, target, relative, info, stats)
+        elif (stat.S_ISLNK(info.st_mode)):
+            self._symlink(source, target, relative, info, stats)
+        elif (stat.S_ISREG(info.st_mode)):
+            self._file(source, target, relative, info, stats)
+        # like rsync without --devices and --specials we skip anything else
+
+    def _directory(self, source, target, relative, info, stats, top=False):
+        if (not top):
+            if (os.path.lexists(target) and not os.path.isdir(target)):
+                os.unlink(target)
+            os.makedirs(target, exist_ok=True)
+
+        with os.scandir(source) as entries:
+            entries = sorted(entries, key=lambda x: x.name)
+
+        for entry in entries:
+            path = "{}/{}".format(relative, entry.name) if relative else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if (self._ignored(path, is_dir) or (is_dir and os.path.realpath(entry.path) in self.skip)):
+                continue
+            self._entry(entry.path, os.path.join(target, entry.name), path, entry.stat(follow_symlinks=False), stats)
+
+        # the contents changed the directory's time so set it last
+        if (not top):
+            self._attributes(target, info)
+
+    def _symlink(self, source, target, relative, info, stats):
+        link = os.readlink(source)
+        if (os.path.islink(target) and os.readlink(target) == link):
+            stats.skipped += 1
+            return
+
+        temporary = self._temporary(target)
+        os.symlink(link, temporary)
+        self._owner(temporary, info)
+        os.replace(temporary, target)
+        stats.copied.append(relative)
+
+    def _file(self, source, target, relative, info, stats):
+        try:
+            existing = os.lstat(target)
+            if (stat.S_ISREG(existing.st_mode) and existing.st_size == info.st_size and existing.st_mtime_ns == info.st_mtime_ns):
+                # only the attributes might be different
+                if (stat.S_IMODE(existing.st_mode) != stat.S_IMODE(info.st_mode)):
+                    os.chmod(target, stat.S_IMODE(info.st_mode))
+                stats.skipped += 1
+                return
+            if (stat.S_ISDIR(existing.st_mode)):
+                shutil.rmtree(target)
+        except FileNotFoundError:
+            pass
+
+        # write somewhere else and move it into place so that nothing ever
+        # sees half of a file.
+        temporary = self._temporary(target)
+        try:
+            if (self.link == "hardlink" and self._same_device(source, target)):
+                os.link(source, temporary)
+            else:
+                self._copy(source, temporary)
+                self._attributes(temporary, info)
+            os.replace(temporary, target)
+        except BaseException:
+            if (os.path.lexists(temporary)):
+                os.unlink(temporary)
+            raise
+
+        stats.copied.append(relative)
+        stats.bytes += info.st_size
+
+    def _copy(self, source, target):
+        if (self.link == "reflink"):
+            with open(source, "rb") as s, open(target, "wb") as t:
+                try:
+                    fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+                    return
+                except OSError:
+                    # not supported here so do it the normal way
+                    pass
+        shutil.copyfile(source, target)
+
+    def _same_device(self, source, target):
+        return os.lstat(source).st_dev == os.stat(os.path.dirname(target)).st_dev
+
+    def _temporary(self, target):
+        return os.path.join(os.path.dirname(target), ".{}.{}.push".format(os.path.basename(target), threading.get_ident()))
+
+    def _attributes(self, path, info):
+        self._owner(path, info)
+        os.chmod(path, stat.S_IMODE(info.st_mode))
+        os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns))
+
+    def _owner(self, path, info):
+        # only root can give files away. we use the numbers, not the names.
+        if (self.owner):
+            os.lchown(path, info.st_uid, info.st_gid)
@@ -1,7 +1,27 @@
 from invoke import Task, run
-from .tools import copy, warn, abort, confirm
+from .tools import copy, warn, abort, confirm, listing
+from . import compression
+from . import cache
+from . import manifest
+from . import ssh
+from . import repo
+from . import parallel
+from . import stream
+from . import transfer
+from . import watch
+from . import prune
+from . import profile
+from . import inventory
+from . import scheduler
 from . import colors
 from . import env
+import contextlib
+import fnmatch
+import tempfile
+import hashlib
+import signal
+import shlex
+import time
 import os
 
 
@@ -14,6 +34,8 @@ __all__ = [
     "ArchiveTask",
     "CloneTask",
     "LiveTask",
+    "RollbackTask",
+    "WatchTask",
     "DeployTask",
 ]
 
@@ -24,16 +46,35 @@ __all__ = [
 class TaskWrapper(Task):
     def __init__(self, *args, **kwargs):
         def run(c):
-            return self.run(c)
+            with profile.span(self.name):
+                result = self.run(c)
+            self.ran = True
+            return result
 
         # the task's documentation will come from the method in our child class
         run.__doc__ = self.run.__doc__
 
         super().__init__(run, *args, **kwargs)
 
+        # set once the task has finished
+        self.ran = False
+
+        # time the hooks on their own too
+        self.before = profile.wrap(self.before, "{}.before".format(self.name))
+        self.after = profile.wrap(self.after, "{}.after".format(self.name))
+
     def run(self, c):
         raise NotImplementedError("{}: property must be implemented in subclass".format(__name__))
 
+    def inputs(self):
+        """returns the paths that this task reads. steps that write to them
+        don't run at the same time as this task."""
+        return []
+
+    def outputs(self):
+        """returns the paths that this task writes"""
+        return []
+
     def before(self, c):
         pass
 
@@ -59,6 +100,7 @@ class MostlyCleanTask(TaskWrapper):
         c.run("rm -rf {}".format(env.archive_dir), hide=True)
         c.run("rm -rf {}".format(env.release_dir), hide=True)
         c.run("rm -rf {}".format(env.test_dir), hide=True)
+        c.run("rm -f {}".format(env.build_inputs), hide=True)
         print(colors.green("Finished mostly cleaning project."))
 
 
@@ -71,9 +113,19 @@ class BuildTask(TaskWrapper):
         # create release directories, build directory gets created by rsync
         os.makedirs(env.release_dir, exist_ok=True)
 
+        # the paths that changed since the last build and the ones that were
+        # added or removed or None if everything is being built.
+        self.changed = None
+        self.added_or_removed = None
+
         # call before hooks
         self.before(c)
 
+        # an incremental build keeps what was built last time and only does
+        # the work for what has changed since then.
+        if (self.incremental()):
+            inputs = self.find_changes()
+
         # copy the root directory into the .push/build directory. need to
         # append the trailing slash to make rsync copy the contents of the
         # current directory rather than the current directory itself.
@@ -82,12 +134,78 @@ class BuildTask(TaskWrapper):
         # call after hooks
         self.after(c)
 
+        # only remember what we built once it has built successfully
+        if (self.incremental()):
+            manifest.save(env.build_inputs, inputs)
+
         print(colors.green("Finished building project."))
 
+    def inputs(self):
+        return [env.current_dir]
+
+    def outputs(self):
+        return [env.build_dir, env.release_dir]
+
+    @staticmethod
+    def incremental():
+        return str(env.get("incremental", os.environ.get("INCREMENTAL", False))) in ["True", "1"]
+
+    def find_changes(self):
+        previous = manifest.load(env.build_inputs)
+        inputs = manifest.scan(env.current_dir, previous or {}, paths=repo.inputs())
+
+        # without a previous build everything gets built
+        if (previous is None or not os.path.isdir(env.build_dir)):
+            print(colors.cyan("Building everything because there is no previous build."))
+            return inputs
+
+        changed, removed = manifest.diff(inputs, previous)
+        self.changed = set(changed + removed)
+        self.added_or_removed = set([x for x in changed if x not in previous] + removed)
+        print(colors.cyan("Building incrementally: {} of {} files changed, {} removed.".format(len(changed), len(inputs), len(removed))))
+
+        # things removed from the project need to be removed from the build
+        # and from where they were copied to in the release
+        for path in removed:
+            for directory in [env.build_dir, env.release_dir]:
+                target = os.path.join(directory, path)
+                if (os.path.lexists(target) and not os.path.isdir(target)):
+                    os.unlink(target)
+
+        return inputs
+
+    def inputs_changed(self, *patterns):
+        """returns True if everything is being built or if any file that
+        matches one of the given patterns changed since the last build. with
+        no patterns it returns True if anything changed."""
+
+        if (self.changed is None):
+            return True
+        if (len(patterns) == 0):
+            return len(self.changed) > 0
+        return any(fnmatch.fnmatch(path, pattern) for path in self.changed for pattern in patterns)
+
+    def inputs_added_or_removed(self, *patterns):
+        """like inputs_changed but only for files that were added to or
+        removed from the project. build tools that list the project's files
+        when they are set up need to be set up again when these change."""
+
+        if (self.added_or_removed is None):
+            return True
+        if (len(patterns) == 0):
+            return len(self.added_or_removed) > 0
+        return any(fnmatch.fnmatch(path, pattern) for path in self.added_or_removed for pattern in patterns)
+
 
 class TestTask(TaskWrapper):
     name = "test"
 
+    def inputs(self):
+        return [env.build_dir, env.release_dir]
+
+    def outputs(self):
+        return [env.build_dir, env.test_dir]
+
     def run(self, c):
         """run project tests"""
 
@@ -111,12 +229,60 @@ class TestTask(TaskWrapper):
 class ArchiveTask(TaskWrapper):
     name = "archive"
 
+    def __init__(self, *args, tests=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # when scheduling, the tests are run by this task while the archive
+        # is being made instead of before it
+        self.tests = tests
+
+    def __call__(self, c, *args, **kwargs):
+        result = super().__call__(c, *args, **kwargs)
+
+        # a run method that doesn't run the tests still gets them run and the
+        # archive is only kept if they pass
+        if (self.tests is not None and not self.tests.ran):
+            try:
+                self.tests(c)
+            except BaseException:
+                self.discard("{}/{}".format(env.archive_dir, env.archive_name))
+                raise
+        return result
+
+    def inputs(self):
+        return [env.release_dir]
+
+    def outputs(self):
+        return [env.archive_dir]
+
     def run(self, c):
         """create deployment archive"""
 
         # create the archive directory
         os.makedirs(env.archive_dir, exist_ok=True)
 
+        # finish putting together what goes in the archive
+        self.assemble(c)
+
+        # create the archive using whatever compression is configured and
+        # remember what is in it so that hosts that have it can be skipped
+        archive = "{}/{}".format(env.archive_dir, env.archive_name)
+        if (self.tests is not None and not self.tests.ran):
+            self.speculate(c, archive)
+        else:
+            self.create(c, archive)
+        compression.write_digest(archive)
+
+        # call after hooks
+        self.after(c)
+
+        print(colors.green("Finished creating archive."))
+
+    def assemble(self, c):
+        """get the release directory ready to be archived. this runs the
+        before hooks and leaves the release directory exactly as it will be
+        archived."""
+
         # call before hooks
         self.before(c)
 
@@ -124,18 +290,68 @@ class ArchiveTask(TaskWrapper):
         if (not os.path.isdir(env.release_dir)):
             abort("No release directory found. Cannot create archive.")
 
-        # clean up empty directories but make sure the release directory exists
-        # sometimes we have projects that don't actually have any files
-        c.run("find {} -type d -empty -delete".format(env.release_dir))
-        os.makedirs(env.release_dir, exist_ok=True)
+        # get rid of cruft and empty directories in one pass
+        self.prune(c)
 
-        # create the archive
-        c.run("tar -czf {}/{} -C {} -p .".format(env.archive_dir, env.archive_name, env.release_dir))
+    def create(self, c, archive, mtime=None):
+        c.run(self.codec().create_command(env.release_dir, archive, mtime=mtime or self.mtime()))
 
-        # call after hooks
-        self.after(c)
+    def speculate(self, c, archive):
+        # make the archive while the tests run and throw it away if they fail
+        temporary = "{}.{}.tmp".format(archive, os.getpid())
+        before = self.snapshot()
+        mtime = self.mtime()
 
-        print(colors.green("Finished creating archive."))
+        with scheduler.Graph() as steps:
+            steps.add("test", lambda: self.tests(scheduler.context(c)), inputs=self.tests.inputs(), outputs=self.tests.outputs())
+            steps.add("archive", lambda: self.create(scheduler.context(c), temporary, mtime), inputs=self.inputs(), outputs=[temporary], discard=lambda: self.discard(temporary))
+
+        # the tests might have changed what was archived out from under it
+        if (self.snapshot() != before):
+            print(colors.yellow("Making the archive again because the tests changed the release directory."))
+            self.discard(temporary)
+            self.prune(c)
+            self.create(c, archive, mtime)
+        else:
+            os.replace(temporary, archive)
+
+    def snapshot(self):
+        # enough about every file in the release directory to tell if any of
+        # them has changed
+        result = {}
+        for directory, directories, files in os.walk(env.release_dir):
+            for name in directories + files:
+                info = os.lstat(os.path.join(directory, name))
+                result[os.path.join(directory, name)] = (info.st_size, info.st_mtime_ns, info.st_mode)
+        return result
+
+    def discard(self, path):
+        for name in [path, compression.digest_path(path)]:
+            if (os.path.exists(name)):
+                os.unlink(name)
+
+    def codec(self):
+        return compression.get()
+
+    def mtime(self):
+        # every file gets the time of the commit so that building the same
+        # commit again makes exactly the same archive. changes that haven't
+        # been committed keep their own times.
+        if (os.environ.get("SOURCE_DATE_EPOCH")):
+            return int(os.environ["SOURCE_DATE_EPOCH"])
+        if (env.repo_is_dirty):
+            return None
+        return env.repo_commit_time
+
+    def prune_rules(self):
+        """returns a list of prune.Rule objects for things that should be
+        removed from the release directory before it is archived. extend this
+        to remove more."""
+        return []
+
+    def prune(self, c):
+        report = prune.prune(env.release_dir, self.prune_rules())
+        print("Pruned release directory: {}.".format(report))
 
 
 class CloneTask(TaskWrapper):
@@ -177,85 +393,574 @@ class LiveTask(Task):
     positional = ["name"]
 
     def __init__(self, *args, **kwargs):
-        def run(c, name):
+        def run(c, name, parallel=0):
             """deploy the project using "live nickname" to deploy to a particular host"""
-            return self.run(c, name)
+            with profile.span(self.name):
+                return self.run(c, name, parallel)
+
+        kwargs.setdefault("help", {
+            "parallel": "deploy to this many hosts at once (default: $PARALLEL or 1)",
+        })
 
         super().__init__(run, *args, **kwargs)
 
+        self.before = profile.wrap(self.before, "{}.before".format(self.name))
+        self.after = profile.wrap(self.after, "{}.after".format(self.name))
+
     def before(self, c, hosts):
         pass
 
     def after(self, c, hosts):
         pass
 
-    def run(self, c, name):
-        # this has all of the host information in it
-        from .hosts import hosts as _hosts
-
-        # these are the hosts that we might deploy to
-        hosts = []
-
-        # is the name a tag name? if it is then get all of the hosts
-        # that the tag maps to and add them to the list
-        if (name in _hosts["tags"]):
-            hosts += _hosts["tags"].get(name, [])
-
-        # is the name a host name?
-        if (name in _hosts["servers"]):
-            hosts.append(name)
+    @staticmethod
+    def hosts(name):
+        # the name can be a tag, a host or a selector that combines them
+        hosts, unknown = inventory.get().select(name)
+        hosts = sorted(hosts)
 
         # if the given name wasn't found then maybe there's a reason for that
-        if (len(hosts) == 0):
+        if (unknown == [name]):
             if (confirm("No server or tag named \"{}\" found in host list. Should we deploy directly to \"{}\"?".format(name, name))):
                 hosts.append(name)
             else:
                 warn("Ignoring \"{}\" because it is not a valid server or tag name.".format(name))
+        elif (len(unknown)):
+            abort("No server or tag matches {}.".format(", ".join("\"{}\"".format(x) for x in unknown)))
+
+        # like "web&db" when nothing has both tags
+        if (len(hosts) == 0):
+            abort("The selector \"{}\" matched no hosts.".format(name))
+
+        return hosts
+
+    def run(self, c, name, workers=0):
+        hosts = self.hosts(name)
+
+        # when keeping releases every host gets one with the same name
+        self.release = None
+        if (int(env.get("releases", os.environ.get("RELEASES", 0))) > 0):
+            self.release = "{}-{}".format(time.strftime("%Y%m%dT%H%M%S", time.gmtime()), env.repo_commit_name[:12])
 
         # call before hooks
         self.before(c, hosts)
 
-        # don't do it in parallel, sometimes the plugin modules have prompts.
-        for host in sorted(hosts):
-            env.deploy(
-                archive="{}/{}".format(env.archive_dir, env.archive_name),
+        workers = parallel.worker_count(workers)
+        streaming = str(env.get("stream", os.environ.get("STREAM", False))) in ["True", "1"]
+        if (streaming and (transfer.enabled() or str(env.get("delta", os.environ.get("DELTA", False))) in ["True", "1"])):
+            # each host is sent something different or sent it another way
+            print(colors.yellow("Not streaming because '{}' is set.".format("chunked" if transfer.enabled() else "delta")))
+            streaming = False
+        if (len(set(hosts)) > 1 and (workers > 1 or streaming)):
+            # the plugin modules sometimes have prompts. when deploying in
+            # parallel each question is only asked once for all of the hosts.
+            env.confirm_answers = {}
+            try:
+                if (streaming):
+                    results = self.broadcast(sorted(set(hosts)), workers)
+                else:
+                    results = parallel.run(sorted(set(hosts)), self.deploy, workers)
+            finally:
+                env.confirm_answers = None
+
+            parallel.summary(results)
+            failed = [x.host for x in results if not x.ok]
+            if (len(failed)):
+                abort("Failed to deploy to {} of {} hosts: {}".format(len(failed), len(results), ", ".join(failed)))
+        else:
+            for host in sorted(hosts):
+                self.deploy(host)
+
+        # call after hooks
+        self.after(c, hosts)
+
+        print(colors.green("Finished deploying project."))
+
+    def broadcast(self, hosts, workers):
+        # the archive is read once and sent to every host at the same time.
+        # the hooks for each host still run on their own before and after.
+        archive = "{}/{}".format(env.archive_dir, env.archive_name)
+        deploys = {}
+
+        def prepare(host):
+            deploys[host] = env.deploy(
+                archive=archive,
                 remote_user=env.host_user,
                 remote_host=host,
                 remote_path=env.host_path,
+                deferred=True,
+                release=self.release,
             )
+            deploys[host].prepare()
+
+        def finish(host):
+            deploys[host].finish()
+
+        prepared = parallel.run(hosts, prepare, workers)
+        ready = [x.host for x in prepared if x.ok and not deploys[x.host].skipped]
+        sent = stream.send(
+            archive,
+            {host: deploys[host].ssh(deploys[host].extract_command()) for host in ready},
+            lag=cache.size_setting("stream_lag", "16M"),
+            timeout=int(env.get("stream_timeout", os.environ.get("STREAM_TIMEOUT", 30))),
+        )
+        for result in sent:
+            if (result.ok):
+                profile.sent(result.host, os.path.getsize(archive))
+        finished = parallel.run([x.host for x in sent if x.ok], finish, workers)
 
-        # call after hooks
-        self.after(c, hosts)
+        return parallel.merge(prepared, sent, finished)
 
-        print(colors.green("Finished deploying project."))
+    def deploy(self, host):
+        env.deploy(
+            archive="{}/{}".format(env.archive_dir, env.archive_name),
+            remote_user=env.host_user,
+            remote_host=host,
+            remote_path=env.host_path,
+            release=self.release,
+        )
+
+
+# this task switches hosts back to a release that was deployed before
+class RollbackTask(Task):
+    name = "rollback"
+    positional = ["name"]
+
+    def __init__(self, *args, **kwargs):
+        def run(c, name, release=None, parallel=0):
+            """switch hosts using "rollback nickname" back to the release before the live one"""
+            with profile.span(self.name):
+                return self.run(c, name, release, parallel)
+
+        kwargs.setdefault("help", {
+            "release": "switch to this release instead of the one before the live one",
+            "parallel": "roll back this many hosts at once (default: $PARALLEL or 1)",
+        })
+
+        super().__init__(run, *args, **kwargs)
+
+    def run(self, c, name, release=None, workers=0):
+        hosts = LiveTask.hosts(name)
+
+        def rollback(host):
+            env.deploy(
+                archive=None,
+                remote_user=env.host_user,
+                remote_host=host,
+                remote_path=env.host_path,
+                deferred=True,
+            ).rollback(release)
+
+        workers = parallel.worker_count(workers)
+        if (len(set(hosts)) > 1 and workers > 1):
+            results = parallel.run(sorted(set(hosts)), rollback, workers)
+            parallel.summary(results)
+            failed = [x.host for x in results if not x.ok]
+            if (len(failed)):
+                abort("Failed to roll back {} of {} hosts: {}".format(len(failed), len(results), ", ".join(failed)))
+        else:
+            for host in sorted(hosts):
+                rollback(host)
+
+        print(colors.green("Finished rolling back project."))
+
+
+# this task stays running and deploys again every time the project changes
+class WatchTask(Task):
+    name = "watch"
+    positional = ["name"]
+
+    def __init__(self, *args, build=None, test=None, archive=None, **kwargs):
+        def run(c, name):
+            """deploy the project using "watch nickname" and again every time that it changes"""
+            with profile.span(self.name):
+                return self.run(c, name)
+
+        super().__init__(run, *args, **kwargs)
+
+        # the tasks that get the release directory ready each time
+        self.build = build
+        self.test = test
+        self.archive = archive
+
+    def run(self, c, name):
+        hosts = sorted(set(LiveTask.hosts(name)))
+
+        # only what changed is built and only what changed is sent. the ssh
+        # connection to each host stays open for as long as this runs.
+        env.incremental = True
+        env.delta = True
+
+        # start watching first so that nothing changed while deploying the
+        # first time is missed
+        watcher = watch.watcher(env.current_dir, [".git", os.path.relpath(env.containment_dir, env.current_dir)])
+        delay = float(env.get("watch_delay", os.environ.get("WATCH_DELAY", 0.1)))
+
+        # Ctrl-C part way through a command comes out of it as whatever error
+        # the command had, or as nothing at all when its error is ignored, so
+        # remember that it was pressed
+        self.interrupted = False
+
+        def interrupt(signum, frame):
+            self.interrupted = True
+            signal.default_int_handler(signum, frame)
+
+        previous = signal.signal(signal.SIGINT, interrupt)
+        try:
+            self.deploy(c, hosts)
+            while (not self.interrupted):
+                print(colors.cyan("Watching for changes. Press Ctrl-C to stop."))
+                changed = watcher.wait(delay)
+                if (changed is None):
+                    print(colors.cyan("Too much changed to keep track of. Building everything that changed."))
+                else:
+                    print(colors.cyan("Changed: {}.".format(", ".join(sorted(changed)[:5]) + (" and {} more".format(len(changed) - 5) if len(changed) > 5 else ""))))
+                self.deploy(c, hosts)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGINT, previous)
+            watcher.close()
+
+        print(colors.green("Stopped watching."))
+
+    def deploy(self, c, hosts):
+        start = time.time()
+
+        # the connections close by themselves while nothing changes
+        ssh.refresh()
+
+        try:
+            self.build(c)
+            if (str(env.get("watch_tests", os.environ.get("WATCH_TESTS", False))) in ["True", "1"]):
+                self.test(c)
+            self.archive.assemble(c)
+
+            # the release directory is sent as it is without archiving it
+            for host in hosts:
+                env.deploy(
+                    archive=None,
+                    remote_user=env.host_user,
+                    remote_host=host,
+                    remote_path=env.host_path,
+                )
+        except (Exception, SystemExit) as e:
+            if (self.interrupted):
+                raise KeyboardInterrupt()
+
+            # keep watching so that the next change can fix whatever it was.
+            # a connection that went away is opened again next time.
+            warn("Deploying failed: {}".format(getattr(e, "message", e)))
+            ssh.reset()
+            return
+
+        print(colors.green("Deployed to {} in {:.1f}s.".format(", ".join(hosts), time.time() - start)))
 
 
 # not a real task
 class DeployTask(object):
-    def __init__(self, archive, remote_user, remote_host, remote_path):
-        # make sure the thing we are deploying exists
-        if (not os.path.isfile("{}/{}".format(env.archive_dir, env.archive_name))):
+    def __init__(self, archive, remote_user, remote_host, remote_path, deferred=False, release=None):
+        # make sure the thing we are deploying exists. there is nothing to
+        # send when rolling back.
+        if (archive is not None and not os.path.isfile("{}/{}".format(env.archive_dir, env.archive_name))):
             abort("No archive file found. Cannot distribute project.")
 
-        # keep track of these for hooks
+        # keep track of these for hooks. when deploying a release everything
+        # happens in a new directory next to the path and the path becomes a
+        # link to it at the end.
         self.archive = archive
         self.remote_user = remote_user
         self.remote_host = remote_host
-        self.remote_path = remote_path
-
-        # call before hook
-        self.before()
+        self.path = remote_path
+        self.release = release
+        self.remote_path = remote_path if release is None else "{}/{}".format(self.releases_path(), release)
+
+        # paths that the hooks have removed from the remote host
+        self.cleaned = []
+
+        # set when the remote host already has this archive
+        self.skipped = False
+
+        # what was sent to a release, saved when it goes live
+        self.sent = None
+
+        # the archive waiting on the remote host, when sending it in pieces
+        self.upload = None
+
+        # remote commands waiting to be sent, when batching
+        self.queued = None
+
+        # time each step of the deploy for each host
+        for step in ["before", "after", "extract"]:
+            setattr(self, step, profile.wrap(getattr(self, step), "deploy.{}".format(step), host=remote_host))
+
+        # a deferred deploy lets the caller run each step itself. this is
+        # used when sending one archive to many hosts at the same time.
+        if (not deferred):
+            self.prepare()
+            self.extract()
+            self.finish()
+
+    def prepare(self):
+        # nothing needs to happen if the remote host already has exactly what
+        # is in the archive
+        deployed = self.remote_digest()
+        if (self.archive is not None and deployed == compression.read_digest(self.archive) and str(env.get("force", os.environ.get("FORCE", False))) not in ["True", "1"]):
+            print(colors.cyan("Skipping {}:{} because it already has {}.".format(self.remote_host, self.path, os.path.basename(self.archive))))
+            self.skipped = True
+            return
+
+        # sending the whole archive changes the remote host without keeping
+        # track of what it has so what we last sent to it is forgotten
+        if (not self.delta() and os.path.exists(self.manifest_path())):
+            os.unlink(self.manifest_path())
+
+        # over a slow link the whole archive is sent before anything on the
+        # remote host is changed
+        if (transfer.enabled() and not self.delta()):
+            self.send()
+
+        # call before hook. anything that the hooks do on the remote host is
+        # sent to it all at once when they are done. what it had is forgotten
+        # first so that a deploy that stops part way is never skipped.
+        with self.batch():
+            if (self.release is not None):
+                self.remote(self.seed_command())
+            if (deployed is not None):
+                self.remote("rm -f {}".format(shlex.quote(self.digest_path(self.remote_path))))
+            self.before()
 
         # NOW we tell people about it. this makes the output print in the correct order
-        print(colors.cyan("Deploying {} to {}:{} as {}.".format(archive, remote_host, remote_path, remote_user)))
+        print(colors.cyan("Deploying {} to {}:{} as {}.".format(self.archive or env.release_dir, self.remote_host, self.remote_path, self.remote_user)))
+
+    def extract(self):
+        if (self.skipped):
+            return
+
+        if (self.delta()):
+            return self.extract_delta()
+
+        # unpack what was already sent to the remote host
+        if (self.upload is not None):
+            run(self.ssh(self.upload.extract_command(self.extract_command())), **parallel.streams())
+            return
 
         # unpack the tar file over the ssh link. we are assuming that the path
         # to tar on the remote host is the same as it is on the local host.
-        run("cat {} | ssh -o ConnectTimeout=10 {} sudo -u {} \"tar zxf - -C {} -p --no-same-owner --overwrite-dir\"".format(archive, remote_host, remote_user, remote_path))
+        run("cat {} | {}".format(self.archive, self.ssh(self.extract_command())), **parallel.streams())
+        profile.sent(self.remote_host, os.path.getsize(self.archive))
+
+    def delta(self):
+        # without an archive the release directory is sent as it is
+        if (self.archive is None):
+            return True
+        return str(env.get("delta", os.environ.get("DELTA", False))) in ["True", "1"]
+
+    def send(self):
+        # send the archive in pieces that are each checked when they arrive,
+        # carrying on from wherever the last try got to
+        self.upload = transfer.Upload(self.archive, compression.read_digest(self.archive), self.remote_host, self.ssh)
+        start = time.time()
+        try:
+            sent = self.upload.send()
+        except transfer.TransferError as e:
+            abort("Could not send {} to {}: {}".format(os.path.basename(self.archive), self.remote_host, e))
+        profile.sent(self.remote_host, sent)
+        print(colors.cyan("Sent {} of {} bytes to {} in {:.1f}s.".format(sent, self.upload.size, self.remote_host, time.time() - start)))
+
+    def extract_delta(self):
+        # we keep a copy of what we last sent to each host. without it we ask
+        # the host what it has of the files we want to send. we never remove
+        # anything we didn't send ourselves because other projects probably
+        # deploy to the same place.
+        saved = self.manifest_path()
+        local = manifest.scan(env.release_dir)
+        remote = manifest.load(saved)
+        if (remote is None):
+            remote = self.remote_manifest(local)
+
+        # anything that the hooks removed needs to be sent again
+        for path in self.cleaned:
+            remote = manifest.without(remote, path)
+
+        changed, removed = manifest.diff(local, remote)
+        print(colors.cyan("Sending {} changed and removing {} deleted of {} files on {}.".format(len(changed), len(removed), len(local), self.remote_host)))
+
+        if (len(changed)):
+            codec = compression.get()
+            with tempfile.NamedTemporaryFile(prefix="push-delta-", dir=env.containment_dir) as files:
+                files.write("\0".join(changed).encode("utf-8"))
+                files.flush()
+
+                # send only the changed files over the ssh link
+                command = codec.create_command(env.release_dir, "-", files=files.name)
+                run("set -o pipefail; {} | {}".format(command, self.ssh(codec.extract_command(self.remote_path))), **parallel.streams())
+
+            # this is before compression so it is more than what was sent
+            profile.sent(self.remote_host, sum(local[path]["size"] for path in changed))
+
+        if (len(removed)):
+            command = "cd {} && xargs -0 -r rm -f --".format(shlex.quote(self.remote_path))
+            with listing(removed) as names:
+                run("{} < {}".format(self.ssh(command, timeout=30), shlex.quote(names)), in_stream=False, **parallel.streams())
+
+        # the host now has exactly what we have. a release only has it once
+        # it has gone live.
+        if (self.release is None):
+            manifest.save(saved, local)
+        else:
+            self.sent = local
+
+    def remote_manifest(self, local):
+        # only ask about regular files, everything else is always sent
+        paths = [path for path in sorted(local) if local[path]["mode"] != "link"]
+        command = manifest.REMOTE_COMMAND.format(shlex.quote(self.remote_path))
+        with listing(paths) as names:
+            result = run("{} < {}".format(self.ssh(command, timeout=30), shlex.quote(names)), in_stream=False, hide=True, warn=True)
+        if (not result.ok):
+            warn("Could not get the list of files on {}. Sending everything.".format(self.remote_host))
+            return {}
+        return manifest.parse_remote(result.stdout)
+
+    def manifest_path(self):
+        # what we last sent to this host and path
+        key = hashlib.sha1("{}@{}:{}".format(self.remote_user, self.remote_host, self.path).encode("utf-8")).hexdigest()[:12]
+        return "{}/manifests/{}-{}.json".format(env.containment_dir, self.remote_host, key)
+
+    def finish(self):
+        if (self.skipped):
+            return
+
+        # the new release goes live before the after hooks so that anything
+        # they restart uses it
+        if (self.release is not None):
+            self.activate(self.release, keep=int(env.get("releases", os.environ.get("RELEASES", 0))))
+            if (self.sent is not None):
+                manifest.save(self.manifest_path(), self.sent)
 
         # call after hook
         self.after()
 
+        # remember what the remote host has now. without an archive it
+        # doesn't have any archive.
+        if (self.archive is None):
+            return
+        self.remote("echo {} > {}".format(compression.read_digest(self.archive), shlex.quote(self.digest_path(self.remote_path))))
+
+    def digest_path(self, path=None):
+        # where the remote host keeps the sha256 of the archive it was last
+        # given for this project. other projects deploy to the same place.
+        return os.path.join(path or self.path, ".push-{}-{}.sha256".format(env.project_name, env.project_component))
+
+    def remote_digest(self):
+        result = run(self.ssh("cat {} 2>/dev/null".format(shlex.quote(self.digest_path()))), hide=True, warn=True, in_stream=False)
+        value = result.stdout.strip() if result.ok else ""
+        return value or None
+
+    def releases_path(self):
+        # every release that has been deployed is kept in here
+        return "{}.releases".format(self.path.rstrip("/"))
+
+    def seed_command(self):
+        # the new release starts as hard links to everything in the one that
+        # is live so that only what changed needs to be written. tar replaces
+        # files instead of writing into them so the live one isn't changed.
+        # the release is thrown away if it exists because it never went live.
+        return "mkdir -p {releases} && rm -rf {release} && if [ -e {path} ]; then cp -al {path}/. {release}; else mkdir {release}; fi".format(
+            releases=shlex.quote(self.releases_path()),
+            release=shlex.quote(self.remote_path),
+            path=shlex.quote(self.path),
+        )
+
+    def activate(self, release, keep=0):
+        # point the path at the release. renaming a link over another link
+        # can't be seen half done. a directory that was deployed to before
+        # there were releases becomes the oldest release.
+        command = [
+            "ln -sfn {target} {path}.push-new",
+            "if [ -d {path} ] && [ ! -L {path} ]; then mv {path} {releases}/00000000T000000-original; fi",
+            "mv -T {path}.push-new {path}",
+        ]
+
+        # only keep the newest releases and never the one that is live
+        if (keep > 0):
+            command.append("cd {releases} && ls -1 | sort -r | tail -n +{skip} | grep -vxF {name} | xargs -r rm -rf --")
+
+        self.remote(" && ".join(command).format(
+            target=shlex.quote("{}/{}".format(self.releases_path(), release)),
+            path=shlex.quote(self.path.rstrip("/")),
+            releases=shlex.quote(self.releases_path()),
+            name=shlex.quote(release),
+            skip=keep + 1,
+        ))
+
+    def rollback(self, release=None):
+        """make an earlier release live again, the one before the live one
+        if none is given. nothing is sent and no hooks are run."""
+
+        command = "cd {} && basename \"$(readlink {})\" && ls -1".format(shlex.quote(self.releases_path()), shlex.quote(self.path.rstrip("/")))
+        result = run(self.ssh(command), hide=True, warn=True, in_stream=False)
+        if (not result.ok):
+            abort("Could not find any releases on {} in {}.".format(self.remote_host, self.releases_path()))
+
+        lines = result.stdout.split("\n")
+        current, releases = lines[0].strip(), sorted(x.strip() for x in lines[1:] if x.strip())
+        if (current not in releases):
+            abort("{}:{} is not a link to a release.".format(self.remote_host, self.path))
+
+        if (release is None):
+            older = [x for x in releases if x < current]
+            if (len(older) == 0):
+                abort("There is no release before {} on {}.".format(current, self.remote_host))
+            release = older[-1]
+        elif (release not in releases):
+            abort("There is no release named {} on {}.".format(release, self.remote_host))
+
+        self.activate(release)
+
+        # what was last sent is no longer what the host has
+        if (os.path.exists(self.manifest_path())):
+            os.unlink(self.manifest_path())
+
+        print(colors.cyan("Rolled back {}:{} from {} to {}.".format(self.remote_host, self.path, current, release)))
+
+    def extract_command(self):
+        # decompress on the remote host with whatever made the archive
+        return compression.for_archive(self.archive).extract_command(self.remote_path)
+
+    def ssh(self, command, timeout=10):
+        # the command line that runs the given shell command on the remote
+        # host as the remote user. every command to a host shares one
+        # connection to it.
+        remote = "sudo -u {} sh -c {}".format(self.remote_user, shlex.quote(command))
+        return "ssh -o ConnectTimeout={} {} {} {}".format(timeout, ssh.options(self.remote_host, timeout), self.remote_host, shlex.quote(remote))
+
+    def remote(self, command, timeout=30):
+        # run a command on the remote host or save it for later if batching
+        if (self.queued is not None):
+            self.queued.append(command)
+        else:
+            run(self.ssh(command, timeout=timeout), **parallel.streams())
+
+    @contextlib.contextmanager
+    def batch(self):
+        """use as "with self.batch():" to send every remote command run inside
+        of the block to the remote host in one go at the end of the block"""
+
+        # already batching so the outer block will send everything
+        if (self.queued is not None):
+            yield
+            return
+
+        self.queued = []
+        try:
+            yield
+            commands, self.queued = self.queued, None
+            if (len(commands)):
+                self.remote(" && ".join("({})".format(x) for x in commands))
+        finally:
+            self.queued = None
+
     def clean(self, path):
         remote_path = os.path.join(self.remote_path, path)
         print(colors.cyan("Removing {}:{} as {}.".format(self.remote_host, remote_path, self.remote_user)))
@@ -263,7 +968,8 @@ class DeployTask(object):
         # log in to the remote host and remove the path. we are assuming
         # that the path to "rm" on the remote host is the same as it is on
         # the local host.
-        run("ssh -o ConnectTimeout=30 {} sudo -u {} \"rm -rf {}\"".format(self.remote_host, self.remote_user, remote_path))
+        self.remote("rm -rf {}".format(shlex.quote(remote_path)))
+        self.cleaned.append(path)
 
     def before(self, **kwargs):
         pass
@@ -0,0 +1,267 @@
+# runs unittest tests in several processes at once. the tests are found the same
+# way as "python -m unittest discover" finds them and split up by test class so
+# that setUpClass still runs once per class. classes that took longest the last
+# time go first, each to whichever process has the least to do, so that all of
+# the processes finish at about the same time. every result is put into one
+# junit style report.
+#
+# this is run with the project's python, usually in its virtualenv, so it only
+# uses the standard library.
+import xml.etree.ElementTree as ElementTree
+import concurrent.futures
+import subprocess
+import traceback
+import unittest
+import argparse
+import tempfile
+import heapq
+import json
+import time
+import re
+import sys
+import os
+
+
+# records what happened to every test
+class Result(unittest.TestResult):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.started = None
+
+    def startTest(self, test):
+        super().startTest(test)
+        self.started = time.perf_counter()
+
+    def _record(self, test, status, message=None, details=None, parent=None):
+        test_id = test.id()
+        test_group = group(parent or test)
+
+        # a failed setUpClass or setUpModule comes as "setUpClass (a.b.C)". it
+        # is named like a test in that class and didn't take any time itself.
+        fixture = type(test).__name__ == "_ErrorHolder"
+        if (fixture):
+            match = re.match(r"^(\w+) \((.+)\)$", test_id)
+            if (match):
+                test_id = "{}.{}".format(match.group(2), match.group(1))
+                test_group = match.group(2)
+
+        self.records.append({
+            "id": test_id,
+            "group": test_group,
+            "status": status,
+            "time": time.perf_counter() - self.started if self.started and not fixture else 0,
+            "message": message,
+            "details": details,
+            "fixture": fixture,
+        })
+
+    def addSuccess(self, test):
+        super().addSuccess(test)
+        self._record(test, "passed")
+
+    def addFailure(self, test, err):
+        super().addFailure(test, err)
+        self._record(test, "failure", str(err[1]), self._exc_info_to_string(err, test))
+
+    def addError(self, test, err):
+        super().addError(test, err)
+        self._record(test, "error", str(err[1]), self._exc_info_to_string(err, test))
+
+    def addSkip(self, test, reason):
+        super().addSkip(test, reason)
+        self._record(test, "skipped", reason)
+
+    def addExpectedFailure(self, test, err):
+        super().addExpectedFailure(test, err)
+        self._record(test, "passed")
+
+    def addUnexpectedSuccess(self, test):
+        super().addUnexpectedSuccess(test)
+        self._record(test, "failure", "unexpected success")
+
+    def addSubTest(self, test, subtest, err):
+        super().addSubTest(test, subtest, err)
+        if (err is not None):
+            status = "failure" if issubclass(err[0], test.failureException) else "error"
+            self._record(subtest, status, str(err[1]), self._exc_info_to_string(err, test), parent=test)
+
+
+def flatten(suite):
+    for test in suite:
+        if (isinstance(test, unittest.TestSuite)):
+            yield from flatten(test)
+        else:
+            yield test
+
+
+def group(test):
+    # tests are shared out one class at a time. the id can't be split up to
+    # find the class because subtests put their parameters on the end of it.
+    return "{}.{}".format(type(test).__module__, type(test).__qualname__)
+
+
+def shard(groups, durations, jobs):
+    """splits the groups into at most jobs lists, slowest first, so that each
+    list takes about as long as the others"""
+
+    known = sorted(durations[x] for x in groups if x in durations)
+    guess = known[len(known) // 2] if known else 1.0
+
+    shards = [(0.0, i, []) for i in range(min(jobs, len(groups)))]
+    heapq.heapify(shards)
+    for name in sorted(groups, key=lambda x: (-durations.get(x, guess), x)):
+        total, i, names = heapq.heappop(shards)
+        names.append(name)
+        heapq.heappush(shards, (total + durations.get(name, guess), i, names))
+    return [x[2] for x in sorted(shards, key=lambda x: x[1])]
+
+
+def run_shard(arguments, names):
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(names, f)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--worker", f.name, "--start-directory", arguments.start_directory]
+        for path in arguments.path:
+            command.extend(["--path", path])
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        try:
+            return json.loads(result.stdout), result.stderr
+        except ValueError:
+            # the whole process died so blame every test in it
+            return [{"id": name, "group": name, "status": "error", "time": 0, "message": "test process exited with {}".format(result.returncode), "details": result.stderr} for name in names], result.stderr
+    finally:
+        os.unlink(f.name)
+
+
+def report(path, records, elapsed, errors=""):
+    count = {x: sum(1 for r in records if r["status"] == x) for x in ["failure", "error", "skipped"]}
+    suites = ElementTree.Element("testsuites")
+    suite = ElementTree.SubElement(suites, "testsuite", {
+        "name": "python",
+        "tests": str(len(records)),
+        "failures": str(count["failure"]),
+        "errors": str(count["error"]),
+        "skipped": str(count["skipped"]),
+        "time": "{:.3f}".format(elapsed),
+    })
+    for record in sorted(records, key=lambda x: x["id"]):
+        classname = record["group"]
+        name = record["id"][len(classname) + 1:] if record["id"].startswith(classname + ".") else record["id"]
+        case = ElementTree.SubElement(suite, "testcase", {"classname": classname, "name": name, "time": "{:.3f}".format(record["time"])})
+        if (record["status"] != "passed"):
+            element = ElementTree.SubElement(case, record["status"], {"message": record["message"] or ""})
+            element.text = record["details"]
+
+    # whatever the tests wrote while they ran
+    if (errors):
+        ElementTree.SubElement(suite, "system-err").text = errors
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    ElementTree.ElementTree(suites).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def load_durations(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_durations(path, durations, records):
+    for record in records:
+        durations[record["group"]] = 0.0
+    for record in records:
+        durations[record["group"]] += record["time"]
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open("{}.tmp".format(path), "w") as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+    os.replace("{}.tmp".format(path), path)
+
+
+def worker(arguments):
+    with open(arguments.worker) as f:
+        names = json.load(f)
+
+    result = Result()
+    for name in names:
+        try:
+            suite = unittest.defaultTestLoader.loadTestsFromName(name)
+        except Exception:
+            result.records.append({"id": name, "group": name, "status": "error", "time": 0, "message": "could not load tests", "details": traceback.format_exc()})
+            continue
+        suite.run(result)
+
+    # anything that the tests print goes to stderr so that stdout only has
+    # the results on it
+    json.dump(result.records, sys.__stdout__)
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="run unittest tests in parallel")
+    parser.add_argument("--start-directory", default=".")
+    parser.add_argument("--pattern", default="test*.py")
+    parser.add_argument("--path", action="append", default=[], help="another directory to import from")
+    parser.add_argument("--jobs", type=int, default=0, help="how many processes to use, zero for one for each core")
+    parser.add_argument("--durations", help="where to keep how long each test class took")
+    parser.add_argument("--junit", help="where to write the junit report")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    arguments = parser.parse_args(argv)
+
+    arguments.start_directory = os.path.abspath(arguments.start_directory)
+    for path in reversed([arguments.start_directory] + [os.path.abspath(x) for x in arguments.path]):
+        sys.path.insert(0, path)
+
+    if (arguments.worker):
+        sys.stdout = sys.stderr
+        return worker(arguments)
+
+    start = time.time()
+    loader = unittest.TestLoader()
+    tests = list(flatten(loader.discover(arguments.start_directory, pattern=arguments.pattern, top_level_dir=arguments.start_directory)))
+
+    # tests that couldn't even be imported are reported here instead of
+    # being sent off to another process
+    records = []
+    broken = [x for x in tests if type(x).__name__ == "_FailedTest"]
+    if (len(broken)):
+        result = Result()
+        for test in broken:
+            test.run(result)
+        records.extend(result.records)
+
+    durations = load_durations(arguments.durations) if arguments.durations else {}
+    groups = sorted(set(group(x) for x in tests if type(x).__name__ != "_FailedTest"))
+    jobs = arguments.jobs or os.cpu_count() or 1
+    shards = shard(groups, durations, jobs)
+    print("Running {} tests from {} classes in {} processes.".format(len(tests), len(groups), len(shards)))
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(shards))) as executor:
+        for shard_records, shard_errors in executor.map(lambda x: run_shard(arguments, x), shards):
+            records.extend(shard_records)
+            errors.append(shard_errors)
+
+    elapsed = time.time() - start
+    if (arguments.junit):
+        report(arguments.junit, records, elapsed, "".join(errors))
+    if (arguments.durations):
+        save_durations(arguments.durations, durations, [x for x in records if not x["id"].startswith("unittest.loader._FailedTest.") and not x.get("fixture")])
+
+    failed = [x for x in records if x["status"] in ["failure", "error"]]
+    for record in failed:
+        print("=" * 70)
+        print("{}: {}".format(record["status"].upper(), record["id"]))
+        print("-" * 70)
+        print(record["details"] or record["message"])
+
+    skipped = sum(1 for x in records if x["status"] == "skipped")
+    print("Ran {} tests in {:.2f}s: {} failed, {} skipped.".format(len(records), elapsed, len(failed), skipped))
+    return 1 if len(failed) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,10 +1,19 @@
-from invoke import run
 from . import colors
+from . import ignore
+from . import sync
 from . import env
+import contextlib
+import functools
+import threading
+import tempfile
 import sys
 import os
 
 
+# only one thread at a time gets to ask a question
+confirm_lock = threading.Lock()
+
+
 def warn(msg):
     sys.stderr.write(colors.magenta("\nWARNING: {}\n\n".format(msg)))
 
@@ -19,11 +28,25 @@ def abort(msg):
 
 
 def confirm(question, assume_yes=True):
+    with confirm_lock:
+        # when deploying to several hosts at once the same question gets asked
+        # for each host. if we are keeping answers then only ask it once.
+        answers = env.get("confirm_answers")
+        if (answers is not None and question in answers):
+            return answers[question]
+
+        answer = _confirm(question, assume_yes)
+        if (answers is not None):
+            answers[question] = answer
+        return answer
+
+
+def _confirm(question, assume_yes):
     suffix = "Y/n" if assume_yes else "y/N"
 
     # Loop till we get something we like
     while (True):
-        response = input(colors.red("{} [{}] ".format(question, suffix)))
+        response = _input(colors.red("{} [{}] ".format(question, suffix)))
         response = response.lower().strip()  # normalize
 
         # default
@@ -42,27 +65,70 @@ def confirm(question, assume_yes=True):
         print("I didn't understand you. Please specify '(y)es' or '(n)o'.")
 
 
-# used to move files around
+def _input(prompt):
+    if (sys.stdin is sys.__stdin__):
+        try:
+            return input(prompt)
+        except EOFError:
+            # nobody is there to answer, like when run by push-batch
+            abort("Could not ask a question because there is no terminal to answer it.")
+
+    # things that run in parallel take stdin away from the commands that they
+    # run so go straight to the terminal for the answer.
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    return sys.__stdin__.readline()
+
+
+@contextlib.contextmanager
+def listing(names):
+    # invoke copies an in_stream to the command one character at a time with
+    # a nap in between, which takes minutes for a few thousand paths. so
+    # long lists go through a file that the shell redirects from instead.
+    with tempfile.NamedTemporaryFile(prefix="push-list-") as f:
+        f.write("\0".join(names).encode("utf-8"))
+        f.flush()
+        yield f.name
+
+
+# the rules for what not to copy only get read once
+@functools.lru_cache(maxsize=None)
+def ignore_rules(git_root_dir, current_dir):
+    # never copy git's files
+    rules = ignore.Rules([".git", ".gitignore"])
+
+    # .gitignore in git-root is required, also use cwd if present
+    rules.load("{}/.gitignore".format(git_root_dir))
+    if (os.path.isfile("{}/.gitignore".format(current_dir))):
+        rules.load("{}/.gitignore".format(current_dir))
+
+    return rules
+
+
+# used to move files around. src can be one path or a list of them.
 def copy(src, dst=None):
+    sources = [src] if isinstance(src, str) else list(src)
+
     # see if the destination needs a default value
     if (dst is None):
         dst = env.release_dir
 
     # if the source is not a full path then prepend it with the build directory
-    if (not os.path.isabs(src)):
-        src = "{}/{}".format(env.build_dir, src)
+    sources = [x if os.path.isabs(x) else "{}/{}".format(env.build_dir, x) for x in sources]
 
     # if the destination is not a full path then prepend it with the
     # release directory.
     if (not os.path.isabs(dst)):
         dst = "{}/{}".format(env.release_dir, dst)
 
-    # make a destination directory, if it doesn't exist
-    os.makedirs(dst, exist_ok=True)
-
-    # .gitignore in git-root is required, also use cwd if present
-    exclude_string = "--exclude=.gitignore --exclude-from={}/.gitignore".format(env.git_root_dir)
-    exclude_string += " --exclude-from=.gitignore " if os.path.isfile(".gitignore") else ""
-
-    # now rsync the data over
-    run("rsync -ah --numeric-ids --exclude=.git {} {} {}".format(exclude_string, src, dst))
+    # now copy the data over. like rsync, a source with a trailing slash has
+    # its contents copied rather than itself.
+    copier = sync.Copier(
+        rules=ignore_rules(env.git_root_dir, os.getcwd()),
+        link=env.get("copy_link", os.environ.get("COPY_LINK", "reflink")),
+        skip=[env.containment_dir],
+    )
+    try:
+        return copier.copy(sources, dst)
+    except OSError as e:
+        abort("Could not copy {} to {}: {}".format(", ".join(sources), dst, e))
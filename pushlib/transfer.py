@@ -0,0 +1,230 @@
+from .tools import warn
+from . import cache
+from . import env
+import subprocess
+import threading
+import fnmatch
+import hashlib
+import signal
+import shlex
+import time
+import os
+
+
+# sends an archive to a remote host one piece at a time into a file that
+# stays there until all of it has arrived. every piece is checked when it
+# arrives and how much has arrived is written down on the remote host so that
+# a transfer that stops part way carries on from there, even in a later run.
+
+# how much is written to ssh at a time, so that a limit can be kept to
+WRITE_SIZE = 64 * 1024
+
+
+def enabled():
+    return str(env.get("chunked", os.environ.get("CHUNKED", False))) in ["True", "1"]
+
+
+# the buckets for a transfer_limit that every host shares, by rate
+shared = {}
+shared_lock = threading.Lock()
+
+
+def bucket(host):
+    """returns the Bucket that sending to the host takes from or None for no
+    limit. transfer_limit can be a size like "20M" that every host shares or
+    a dict of host globs to sizes where the first one that matches is what
+    that host gets to itself."""
+
+    value = env.get("transfer_limit", os.environ.get("TRANSFER_LIMIT"))
+    if (isinstance(value, dict)):
+        value = next((x for pattern, x in value.items() if fnmatch.fnmatch(host, pattern)), None)
+        if (value in [None, "", 0, "0"]):
+            return None
+        return Bucket(cache.parse_size(value))
+
+    if (value in [None, "", 0, "0"]):
+        return None
+    rate = cache.parse_size(value)
+    with shared_lock:
+        if (rate not in shared):
+            shared[rate] = Bucket(rate)
+        return shared[rate]
+
+
+class Bucket(object):
+    """a token bucket that fills at rate bytes a second and holds one write.
+    it is safe to share between the threads deploying to several hosts."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = WRITE_SIZE
+        self.time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, count):
+        # whoever takes more than there is goes into debt and waits it out.
+        # the next one to take waits for that debt to be paid first.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(WRITE_SIZE, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+        if (wait > 0):
+            time.sleep(wait)
+
+
+class TransferError(Exception):
+    pass
+
+
+class Upload(object):
+    def __init__(self, archive, digest, host, ssh):
+        self.archive = archive
+        self.digest = digest
+        self.host = host
+
+        # a function that turns a shell command into the command line that
+        # runs it on the remote host
+        self.ssh = ssh
+
+        # the same archive always goes to the same place so that it can be
+        # picked up again by the next run if this one doesn't finish
+        directory = env.get("transfer_dir", os.environ.get("TRANSFER_DIR", "/var/tmp"))
+        self.path = "{}/push-{}.part".format(directory.rstrip("/"), digest)
+
+        self.size = os.path.getsize(archive)
+        self.chunk_size = cache.size_setting("chunk_size", "8M")
+        self.bucket = bucket(host)
+        self.retries = int(env.get("transfer_retries", os.environ.get("TRANSFER_RETRIES", 5)))
+        self.timeout = int(env.get("transfer_timeout", os.environ.get("TRANSFER_TIMEOUT", 60)))
+
+    def progress(self):
+        # how many bytes of the archive the remote host has and has checked
+        command = "cat {} 2>/dev/null || echo 0".format(shlex.quote("{}.progress".format(self.path)))
+        result = subprocess.run(self.ssh(command), shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if (result.returncode != 0):
+            raise TransferError("could not ask how much has been sent: {}".format(result.stderr.strip()))
+        try:
+            return min(int(result.stdout.strip() or 0), self.size)
+        except ValueError:
+            return 0
+
+    def send(self):
+        """send whatever the remote host doesn't have yet and check all of it.
+        returns how many bytes were sent."""
+
+        offset = self.progress()
+        if (offset > 0):
+            print("Resuming upload to {} at {} of {} bytes.".format(self.host, offset, self.size))
+
+        sent = 0
+        failures = 0
+        with open(self.archive, "rb") as f:
+            while (True):
+                try:
+                    while (offset < self.size):
+                        f.seek(offset)
+                        data = f.read(self.chunk_size)
+                        self.send_chunk(offset, data)
+                        offset += len(data)
+                        sent += len(data)
+                        failures = 0
+
+                    # the pieces all checked out but make sure that together
+                    # they are the archive before anything uses them
+                    self.verify()
+                    return sent
+                except TransferError as e:
+                    failures += 1
+                    if (failures > self.retries):
+                        raise TransferError("gave up after {} tries: {}".format(failures, e))
+                    warn("Sending to {} failed, trying again: {}".format(self.host, e))
+                    time.sleep(min(2 ** failures, 30))
+
+                    # the remote host might have gotten it even though we
+                    # didn't hear back
+                    offset = self.progress()
+
+    def verify(self):
+        # what was sent is thrown away if it doesn't match so that the next
+        # try starts over
+        command = "echo \"{digest}  {part}\" | sha256sum -c --status || {{ rm -f {part} {part}.progress; exit 1; }}".format(
+            digest=self.digest,
+            part=shlex.quote(self.path),
+        )
+        result = subprocess.run(self.ssh(command), shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        if (result.returncode != 0):
+            raise TransferError("what was sent does not match the archive {}".format(result.stderr.strip()).strip())
+
+    def send_chunk(self, offset, data):
+        # the remote host keeps the piece to one side until it checks out and
+        # then puts it where it goes, replacing anything already there.
+        command = "; ".join([
+            "set -e",
+            "umask 077",
+            "cat > {part}.chunk",
+            "echo \"{digest}  {part}.chunk\" | sha256sum -c --status",
+            "truncate -s {offset} {part}",
+            "cat {part}.chunk >> {part}",
+            "rm -f {part}.chunk",
+            "echo {end} > {part}.progress",
+        ]).format(
+            part=shlex.quote(self.path),
+            digest=hashlib.sha256(data).hexdigest(),
+            offset=offset,
+            end=offset + len(data),
+        )
+
+        process = subprocess.Popen(self.ssh(command), shell=True, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+
+        # give up on a connection that stops taking what we send
+        stalled = []
+
+        def stall():
+            stalled.append(True)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = None
+        try:
+            for position in range(0, len(data), WRITE_SIZE):
+                piece = data[position:position + WRITE_SIZE]
+
+                # stay under the limit by waiting for the bucket to have room
+                if (self.bucket is not None):
+                    self.bucket.take(len(piece))
+
+                timer = threading.Timer(self.timeout, stall)
+                timer.start()
+                process.stdin.write(piece)
+                process.stdin.flush()
+                timer.cancel()
+        except (BrokenPipeError, OSError):
+            # the remote end went away. the exit code will say why.
+            pass
+        finally:
+            if (timer is not None):
+                timer.cancel()
+
+        try:
+            error = process.communicate(timeout=self.timeout)[1]
+        except subprocess.TimeoutExpired:
+            stall()
+            error = process.communicate()[1]
+
+        if (stalled):
+            raise TransferError("nothing was sent for {} seconds".format(self.timeout))
+        if (process.returncode != 0):
+            raise TransferError("exit code {}: {}".format(process.returncode, error.decode("utf-8", "replace").strip()).strip(": "))
+
+    def extract_command(self, extract):
+        """returns the remote command that gives everything that was sent to
+        the given command and then removes it"""
+
+        return "{extract} < {part} && rm -f {part} {part}.progress".format(
+            part=shlex.quote(self.path),
+            extract=extract,
+        )
@@ -0,0 +1,190 @@
+from . import repo
+from . import env
+import ctypes.util
+import ctypes
+import select
+import struct
+import time
+import os
+
+
+# tells "push watch" when something in the project has changed. inotify is
+# used where there is one and otherwise everything is looked at every so
+# often. what changed is only used to decide whether to build again. the
+# incremental build works out exactly what to do.
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct("iIII")
+
+
+def _skipped(path, skip):
+    return any(path == x or path.startswith(x + os.sep) for x in skip)
+
+
+def _relevant(paths, skip):
+    # only what git would consider part of the project
+    paths = sorted(set(x for x in paths if not _skipped(x, skip)))
+    if (len(paths) == 0):
+        return []
+    ignored = repo.ignored(paths)
+    return [x for x in paths if x not in ignored]
+
+
+class InotifyWatcher(object):
+    def __init__(self, root, skip):
+        self.root = root
+        self.skip = skip
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if (self.fd < 0):
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # watch descriptor => directory relative to the root
+        self.directories = {}
+        self.watch("")
+
+    def watch(self, directory):
+        # watch the directory and everything under it that isn't ignored
+        pending = [directory]
+        while (len(pending)):
+            found = []
+            for path in pending:
+                descriptor = self.add_watch(self.fd, os.path.join(self.root, path).encode(), MASK)
+                if (descriptor < 0):
+                    # gone already or there are too many. either way there is
+                    # nothing else that can be done about it.
+                    continue
+                self.directories[descriptor] = path
+
+                try:
+                    for entry in os.scandir(os.path.join(self.root, path)):
+                        if (entry.is_dir(follow_symlinks=False)):
+                            found.append(os.path.join(path, entry.name))
+                except OSError:
+                    pass
+
+            found = [x for x in found if not _skipped(x, self.skip)]
+            ignored = repo.ignored(["{}/".format(x) for x in found]) if len(found) else set()
+            pending = [x for x in found if "{}/".format(x) not in ignored]
+
+    def read(self, timeout):
+        # returns the paths that had something happen to them, None if too
+        # much happened to keep track of
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if (not ready):
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while (offset < len(data)):
+            descriptor, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+            offset += EVENT.size + length
+
+            if (mask & IN_Q_OVERFLOW):
+                return None
+            if (mask & IN_IGNORED):
+                self.directories.pop(descriptor, None)
+                continue
+
+            directory = self.directories.get(descriptor)
+            if (directory is None):
+                continue
+            path = os.path.join(directory, name) if name else directory
+
+            # a new directory needs watching too, with whatever is in it
+            if (mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not _skipped(path, self.skip)):
+                if ("{}/".format(path) not in repo.ignored(["{}/".format(path)])):
+                    self.watch(path)
+            paths.append(path)
+        return paths
+
+    def wait(self, delay):
+        """blocks until something changes and then until nothing has changed
+        for "delay" seconds. returns what changed, None for anything."""
+
+        changed = set()
+        while (len(changed) == 0):
+            paths = self.read(None)
+            if (paths is None):
+                return None
+            changed.update(_relevant(paths, self.skip))
+
+        while (True):
+            paths = self.read(delay)
+            if (paths is None):
+                return None
+            if (len(paths) == 0):
+                return changed
+            changed.update(_relevant(paths, self.skip))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    def __init__(self, root, skip, interval):
+        self.root = root
+        self.skip = skip
+        self.interval = interval
+        self.files = self.scan()
+
+    def scan(self):
+        result = {}
+        for path in repo.inputs():
+            try:
+                info = os.lstat(os.path.join(self.root, path))
+            except FileNotFoundError:
+                continue
+            result[path] = (info.st_size, info.st_mtime_ns, info.st_mode)
+        return result
+
+    def wait(self, delay):
+        while (True):
+            time.sleep(self.interval)
+            files = self.scan()
+            changed = set(x for x in set(files) | set(self.files) if files.get(x) != self.files.get(x))
+            self.files = files
+            changed = set(x for x in changed if not _skipped(x, self.skip))
+            if (len(changed)):
+                return changed
+
+    def close(self):
+        pass
+
+
+def watcher(root, skip):
+    """returns something with a "wait" method that blocks until something
+    under root changes. paths in skip, relative to root, are never looked at."""
+
+    interval = float(env.get("watch_interval", os.environ.get("WATCH_INTERVAL", 0.5)))
+    if (str(env.get("watch_poll", os.environ.get("WATCH_POLL", False))) not in ["True", "1"]):
+        try:
+            return InotifyWatcher(root, skip)
+        except (OSError, AttributeError):
+            # no inotify here
+            pass
+    return PollingWatcher(root, skip, interval)